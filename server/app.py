@@ -21,6 +21,8 @@ from libraries.abort_utils import (
     cleanup_user_abort_event)
 from libraries.utils import (TimeUnit, ExecutionPlan, Machines, LN_ProductionOrders, DataHandler, Items)
 from libraries.main_handler import executePandS, processExtrusionInput
+from libraries.settings import update_settings
+from libraries.algorithms import startTorcWorkers
 
 # Load the .env file with environment variables
 load_dotenv('.env')
@@ -51,8 +53,8 @@ app.config.update(
     DRIVER=os.environ.get('DRIVER', '{ODBC Driver 17 for SQL Server}')
 )
 
-# Create thread pool and tracking dictionaries
-executor = ThreadPoolExecutor(max_workers=5)
+# Thread pool of the algorithm runs, created by init_app, and tracking dictionaries
+executor = None
 running_algorithms = {}
 
 # Load data from both databases
@@ -68,12 +70,18 @@ connection_strings = {
                     f'TrustServerCertificate=yes;'
 }
 
-for db_name, connection_string in connection_strings.items():
-    DataHandler.readDBData(connection_string, db_name)
-
 # Enable CORS
 CORS(app, resources={r'/*': {'origins': '*'}}, supports_credentials=True)
 
+def init_app():
+    """Create the algorithm thread pool, load the data of both databases and start the Torc worker pool.
+    Called once at server start and not on import, the spawned Torc workers import this module again."""
+    global executor
+    executor = ThreadPoolExecutor(max_workers=5)
+    for db_name, connection_string in connection_strings.items():
+        DataHandler.readDBData(connection_string, db_name)
+    startTorcWorkers()
+
 def get_chart_data(database):
     time_unit_instances = TimeUnit.GR_instances if database == "COFACTORY_GR" else TimeUnit.PT_instances
     machine_instances = Machines.GR_instances if database == "COFACTORY_GR" else Machines.PT_instances
@@ -856,6 +864,17 @@ def run_algorithm():
         # Check if PT_Settings should be enabled
         PT_Settings = True if dataHandler.Database == "COFACTORY_PT" else False
 
+        # Optional algorithm settings for this run, e.g. {"settings": {"rod_max_combinations": 500}}
+        data = request.get_json(silent=True) or {}
+        invalid_settings, ignored_settings = update_settings(dataHandler, data.get('settings'))
+        if invalid_settings or ignored_settings:
+            return jsonify({
+                'status': 'error',
+                'message': 'Definições do algoritmo inválidas.',
+                'invalid_settings': invalid_settings,
+                'ignored_settings': ignored_settings
+            }), 400
+
         # Initialize the algorithm status
         running_algorithms[user_id] = {
             "id": str(uuid.uuid4()),
@@ -1270,6 +1289,8 @@ def download_file(folder_name, filename):
     return send_from_directory(plan_folder, filename, as_attachment=True)
    
 if __name__ == '__main__':
+    init_app()
+
     # Start the temp cleanup scheduler before running the app
     scheduler = BackgroundScheduler()
     
@@ -1,37 +1,134 @@
 from ortools.linear_solver import pywraplp
+from ortools.sat.python import cp_model
 from itertools import product, groupby, chain
+from bisect import bisect_left
 import copy
+import heapq
 from datetime import datetime, timedelta, time
 import time as tm
 import pyodbc
 import random
 import math
 import numpy as np
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
 from .abort_utils import abortable_loop, check_abort, AbortedException
+from .settings import get_setting
 from .utils import (TimeUnit, Items)
 
+def countCombinations(groups):
+    """Number of combinations picking one alternative from each group"""
+    return math.prod(len(group) for group in groups)
+
+def boundedCombinations(groups, max_combinations, seed=0):
+    """Lazily yield combinations picking one alternative from each group, like product(*groups).
+    If there are more than max_combinations, a deterministic sample of max_combinations is yielded instead,
+    visiting the mixed-radix indices 0, step, 2*step, ... (mod total) with step coprime to the total."""
+    if max_combinations < 1:
+        raise ValueError(f"max_combinations must be at least 1, got {max_combinations}")
+    groups = [list(group) for group in groups]
+    total = countCombinations(groups)
+
+    # A single combination is always enumerated, there is no step to draw
+    if total <= 1 or total <= max_combinations:
+        yield from product(*groups)
+        return
+
+    rng = random.Random(seed)
+    step = rng.randrange(1, total)
+    while math.gcd(step, total) != 1:
+        step = rng.randrange(1, total)
+
+    # Index 0 is always visited, so the combination of the first BoM of every item is never skipped
+    for k in range(max_combinations):
+        index = (k * step) % total
+        combination = []
+        for group in reversed(groups):
+            index, choice = divmod(index, len(group))
+            combination.append(group[choice])
+        combination.reverse()
+        yield tuple(combination)
+
+def grayCodeCombinations(groups):
+    """Lazily yield every combination picking one alternative from each group, in reflected
+    mixed-radix Gray code order: consecutive combinations differ in the choice of a single group."""
+    groups = [list(group) for group in groups]
+    if any(not group for group in groups):
+        return
+
+    choice = [0] * len(groups)
+    yield tuple(group[0] for group in groups)
+
+    # Only groups with alternatives take part in the code (loopless algorithm with focus pointers)
+    varying = [idx for idx, group in enumerate(groups) if len(group) > 1]
+    n = len(varying)
+    direction = [1] * n
+    focus = list(range(n + 1))
+
+    while True:
+        j = focus[0]
+        focus[0] = 0
+        if j == n:
+            return
+        group_idx = varying[j]
+        choice[group_idx] += direction[j]
+        if choice[group_idx] == 0 or choice[group_idx] == len(groups[group_idx]) - 1:
+            direction[j] = -direction[j]
+            focus[j] = focus[j + 1]
+            focus[j + 1] = j + 1
+        yield tuple(group[choice[idx]] for idx, group in enumerate(groups))
+
 class RODPandS():
-    def __init__(self, DataHandler):
+    def __init__(self, DataHandler, user_id=None):
         self.DataHandler = DataHandler
         self.Machines, self.RODItems = self.DataHandler.RODMachines, self.DataHandler.RODItems
-        self.InitialSolution = self.Operations = self.MachinePreviousPlanCoT = None
+        self.user_id = user_id
+        self.InitialSolution = self.Operations = self.MachinePreviousPlanCoT = self.OperationsPerMachine = None
+        self.MachineObjFun = {}  # Machine -> tardiness of its last evaluation
+        # Assignment of the current combination: execution plans in processing order and, for each, the machine,
+        # batch key and previous open batch, so consecutive combinations only replay what changed
+        self.AssignmentOrder, self.AssignmentLog = [], []
+        self.AssignedCount, self.OpenBatches, self.MachinePreferenceCache = defaultdict(int), {}, {}
+        self._init_caches()
+
+    def _init_caches(self):
+        """Index setup times, cycle times, material types and routings (first match wins, as in the linear lookups)"""
+        self.SetupTimesCache, self.CycleTimesCache, self.MaterialTypeCache, self.ItemMaterialTypeCache = {}, {}, {}, {}
+        self.RoutingCache = defaultdict(list)
+        machine_dict = {m.MachineCode: m for m in self.Machines if m.IsActive}
+
+        for st in self.DataHandler.SetupTimesByMaterial:
+            self.SetupTimesCache.setdefault((st.FromMaterial, st.ToMaterial), float(st.SetupTime))
+        for routing in self.DataHandler.Routings:
+            self.CycleTimesCache.setdefault((routing.Machine, routing.Item), routing.CycleTime / 1000)
+            if routing.Machine in machine_dict and machine_dict[routing.Machine] not in self.RoutingCache[routing.Item]:
+                self.RoutingCache[routing.Item].append(machine_dict[routing.Machine])
+        for item in self.RODItems:
+            self.MaterialTypeCache.setdefault(item.Name, item.MaterialType)
+        for item in self.DataHandler.Items:
+            self.ItemMaterialTypeCache.setdefault(item.Name, item.MaterialType)
 
     def generateSolution(self, Combination):
-        '''Generates a randomized initial solution.'''
-        initial_solution = {machine.MachineCode: [] for machine in self.Machines if machine.IsActive}  # Use machine names
+        '''Assigns the execution plans of a combination to the machines, by ascending due date and grouped by product
+        and production order, each to its preferred machine with room left in its share of the operations.
+        Operations are numbered by execution plan id. The assignment of the previous combination is kept up to the
+        first execution plan where the processing order differs, and only the rest is undone and replayed.
+        Returns the machines whose operations changed, or None if all of them were rebuilt.'''
         sorted_exec_plans = sorted(Combination, key=lambda x: x.ProductionOrder.DD)
-        operations = {i + 1: ep for i, ep in enumerate(sorted_exec_plans)}
 
+        # Machines able to run the operations, in order of first use
         possible_machines = []
-        for op_number, data in operations.items():
-            for routing in self.DataHandler.Routings:
-                if routing.Item == data.ItemRelated.Name:
-                    for machine in self.Machines:
-                        if machine.IsActive and routing.Machine == machine.MachineCode and machine not in possible_machines:
-                            possible_machines.append(machine)
+        for item_name in dict.fromkeys(exec_plan.ItemRelated.Name for exec_plan in sorted_exec_plans):
+            for machine in self.RoutingCache.get(item_name, []):
+                if machine not in possible_machines:
+                    possible_machines.append(machine)
 
-        total_operations = len(operations)
+        total_operations = len(sorted_exec_plans)
 
         # Calculate total machine output capacity
         total_output_capacity = sum(machine.Output for machine in possible_machines)
@@ -54,94 +151,136 @@ class RODPandS():
                 if remainder == 0:
                     break
 
-        product_batches = {}
-        for op_number, data in operations.items():
-            product_name = data.ItemRelated.Name
-            prod_order_id = data.ProductionOrder.id
-            # Create a unique key for each product type and due date
-            product_key = (product_name, prod_order_id)
-            if product_key not in product_batches:
-                product_batches[product_key] = []
-            product_batches[product_key].append(op_number)
-
-        for _, op_n in product_batches.items():
-            for op_number, data in operations.items():
-                if op_number in op_n:
-                    possible_machines = [machine for routing in self.DataHandler.Routings if
-                                         routing.Item == data.ItemRelated.Name
-                                         for machine in self.Machines if machine.IsActive and routing.Machine == machine.MachineCode]
-                    if self.DataHandler.Criteria[1]:
-                        machine_cycle_weight = {}
-                        for routing in self.DataHandler.Routings:
-                            if routing.Item == data.ItemRelated.Name:
-                                cycle_time = (routing.CycleTime / 1000) * data.ProductionOrder.Quantity
-                                weight = routing.Weight
-                                machine_cycle_weight[routing.Machine] = (cycle_time, weight)
-
-                        # Sort possible machines by cycle time, using the highest weight as a tiebreaker
-                        possible_machines.sort(key=lambda machine: (
-                            machine_cycle_weight.get(machine.MachineCode, (float('inf'), float('-inf')))[0],
-                            -machine_cycle_weight.get(machine.MachineCode, (float('inf'), float('-inf')))[1]
-                        ))
-                    # Choose the machine with highest weight
-                    else:
-                        machine_weight = {}
-                        for routing in self.DataHandler.Routings:
-                            if routing.Item == data.ItemRelated.Name:
-                                machine_weight[routing.Machine] = routing.Weight
-                        possible_machines.sort(
-                            key=lambda machine: machine_weight.get(machine.MachineCode, float('inf')), reverse=True
-                        )
-                    # Sort possible machines by processing time
-                    if possible_machines:
-                        for _, (machine) in enumerate(possible_machines):
-                            machine_name = machine.MachineCode
-                            if machine.Output == 1 and len(initial_solution[machine_name]) >= operations_per_machine[
-                                machine_name]:
-                                continue  # Skip to the next machine
-                            elif machine.Output > 1:
-                                total_items = sum(len(subsolution) for subsolution in initial_solution[machine_name])
-                                if total_items >= operations_per_machine[machine_name]:
-                                    continue
-                            # Assign the operation to the machine
-                            if machine.Output > 1:
-                                added = False
-                                for subsolution in initial_solution[machine_name]:
-                                    # Check if the sublist contains items from the same product and has space
-                                    if (len(subsolution) < machine.Output and
-                                            operations[subsolution[0]].ItemRelated.Name == data.ItemRelated.Name and
-                                            operations[subsolution[0]].ProductionOrder.id == data.ProductionOrder.id):
-                                        subsolution.append(op_number)
-                                        added = True
-                                        break
-
-                                # If no suitable sublist found, create a new one for this product
-                                if not added:
-                                    initial_solution[machine_name].append([op_number])
-                            else:
-                                # For machines with output 1, simply add the operation
-                                initial_solution[machine_name].append(op_number)
-                            break
+        # Processing order: the execution plans of each product and production order, by first due date
+        product_batches = defaultdict(list)
+        for exec_plan in sorted_exec_plans:
+            product_batches[exec_plan.ItemRelated.Name, exec_plan.ProductionOrder.id].append(exec_plan)
+        order = list(chain.from_iterable(product_batches.values()))
+
+        # The assignment only depends on the processing order and the shares, so the common prefix is kept
+        keep = 0
+        if self.InitialSolution is not None and operations_per_machine == self.OperationsPerMachine:
+            limit = min(len(order), len(self.AssignmentOrder))
+            while keep < limit and order[keep] is self.AssignmentOrder[keep]:
+                keep += 1
+        if keep:
+            updated_machines = self.undoAssignments(keep)
+        else:
+            updated_machines = None
+            self.InitialSolution = {machine.MachineCode: [] for machine in self.Machines if machine.IsActive}
+            self.Operations, self.AssignedCount, self.OpenBatches = {}, defaultdict(int), {}
+            self.AssignmentOrder, self.AssignmentLog = [], []
+            self.OperationsPerMachine = operations_per_machine
+
+        for exec_plan in order[keep:]:
+            machine_name = self.assignExecPlan(exec_plan)
+            if updated_machines is not None and machine_name is not None:
+                updated_machines.add(machine_name)
+
+        # The previous plans come from the DB and are the same for every combination
+        if self.MachinePreviousPlanCoT is None:
+            self.MachinePreviousPlanCoT = {machine: self.getPreviousPlanCoT(machine) or None for machine in self.InitialSolution}
+
+        return updated_machines
+
+    def machinePreference(self, exec_plan):
+        '''Machines able to run an execution plan, by ascending cycle time with the highest weight as tiebreaker, or
+        by descending weight. Cached per item and quantity, the routings are only scanned once.'''
+        key = (exec_plan.ItemRelated.Name, exec_plan.ProductionOrder.Quantity)
+        if key in self.MachinePreferenceCache:
+            return self.MachinePreferenceCache[key]
+
+        possible_machines = list(self.RoutingCache.get(key[0], []))
+        if self.DataHandler.Criteria[1]:
+            machine_cycle_weight = {}
+            for routing in self.DataHandler.Routings:
+                if routing.Item == key[0]:
+                    cycle_time = (routing.CycleTime / 1000) * key[1]
+                    machine_cycle_weight[routing.Machine] = (cycle_time, routing.Weight)
+
+            # Sort possible machines by cycle time, using the highest weight as a tiebreaker
+            possible_machines.sort(key=lambda machine: (
+                machine_cycle_weight.get(machine.MachineCode, (float('inf'), float('-inf')))[0],
+                -machine_cycle_weight.get(machine.MachineCode, (float('inf'), float('-inf')))[1]
+            ))
+        # Choose the machine with highest weight
+        else:
+            machine_weight = {}
+            for routing in self.DataHandler.Routings:
+                if routing.Item == key[0]:
+                    machine_weight[routing.Machine] = routing.Weight
+            possible_machines.sort(
+                key=lambda machine: machine_weight.get(machine.MachineCode, float('inf')), reverse=True
+            )
+
+        self.MachinePreferenceCache[key] = possible_machines
+        return possible_machines
+
+    def assignExecPlan(self, exec_plan):
+        '''Assign an execution plan to its first preferred machine with room left, in the open batch of its product
+        and production order on machines with Output > 1, and log it. Returns the machine, or None.'''
+        op_number = exec_plan.id
+        self.Operations[op_number] = exec_plan
+        self.AssignmentOrder.append(exec_plan)
+        for machine in self.machinePreference(exec_plan):
+            machine_name = machine.MachineCode
+            if self.AssignedCount[machine_name] >= self.OperationsPerMachine[machine_name]:
+                continue  # Skip to the next machine
+
+            # Assign the operation to the machine
+            if machine.Output > 1:
+                # Fill the open batch of this product and production order, or open a new one
+                batch_key = (machine_name, exec_plan.ItemRelated.Name, exec_plan.ProductionOrder.id)
+                previous_batch = batch = self.OpenBatches.get(batch_key)
+                if batch is None or len(batch) >= machine.Output:
+                    batch = self.OpenBatches[batch_key] = []
+                    self.InitialSolution[machine_name].append(batch)
+                batch.append(op_number)
+                self.AssignmentLog.append((machine_name, batch_key, previous_batch))
+            else:
+                # For machines with output 1, simply add the operation
+                self.InitialSolution[machine_name].append(op_number)
+                self.AssignmentLog.append((machine_name, None, None))
+            self.AssignedCount[machine_name] += 1
+            return machine_name
 
-        MachinePreviousPlanCoT = {machine: self.getPreviousPlanCoT(machine) or None for machine in initial_solution}
+        self.AssignmentLog.append((None, None, None))
+        return None
 
-        # print(
-        #    "Initial Random Solution with Operations Ordered by Ascending Due Date and Placed in Machines with Least Processing Time: {}".format(
-        #        initial_solution))
+    def undoAssignments(self, keep):
+        '''Undo the assignments after the first keep execution plans, latest first. Returns the machines changed.'''
+        updated_machines = set()
+        while len(self.AssignmentLog) > keep:
+            exec_plan = self.AssignmentOrder.pop()
+            machine_name, batch_key, previous_batch = self.AssignmentLog.pop()
+            del self.Operations[exec_plan.id]
+            if machine_name is None:
+                continue
+
+            if batch_key is None:
+                self.InitialSolution[machine_name].pop()
+            else:
+                batch = self.OpenBatches[batch_key]
+                batch.pop()
+                # A batch opened by this execution plan is the machine's last entry
+                if not batch:
+                    self.InitialSolution[machine_name].pop()
+                    if previous_batch is None:
+                        del self.OpenBatches[batch_key]
+                    else:
+                        self.OpenBatches[batch_key] = previous_batch
+            self.AssignedCount[machine_name] -= 1
+            updated_machines.add(machine_name)
+        return updated_machines
 
-        self.InitialSolution, self.Operations, self.MachinePreviousPlanCoT = initial_solution, operations, MachinePreviousPlanCoT
-        
     def getSetupTime(self, prev_type, cur_type):
-        return next((float(instance.SetupTime) for instance in self.DataHandler.SetupTimesByMaterial
-                     if instance.FromMaterial == prev_type and instance.ToMaterial == cur_type), 0.0)
+        return self.SetupTimesCache.get((prev_type, cur_type), 0.0)
 
     def getCycleTime(self, machine, item_name):
-        return next(((routing.CycleTime / 1000) for routing in self.DataHandler.Routings
-                     if routing.Item == item_name and routing.Machine == machine), None)
+        return self.CycleTimesCache.get((machine, item_name), None)
 
     def getMaterialType(self, item_name):
-        return next((ROD_item.MaterialType for ROD_item in self.RODItems if ROD_item.Name == item_name),
-                    None)
+        return self.MaterialTypeCache.get(item_name, None)
 
     def nextShiftStartTime(self, current_time, shift_start_times):
         """Calculate next available shift start time"""
@@ -190,9 +329,9 @@ class RODPandS():
         data.CoT = data.ST + timedelta(minutes=CT)
 
     def Planning(self):
-        # Gather all unique MDW-related items
-        tref_list = {exec_plan.ItemRelated for exec_plan in self.DataHandler.ExecutionPlans if
-                     exec_plan.ItemRelated.Process == "MDW"}
+        # Gather all unique MDW-related items, in a fixed order so the enumeration is reproducible
+        tref_list = sorted({exec_plan.ItemRelated for exec_plan in self.DataHandler.ExecutionPlans if
+                            exec_plan.ItemRelated.Process == "MDW"}, key=lambda item: item.Name)
 
         # Create ROD execution plans for each MDW item
         ROD_exec_plans = {}
@@ -210,63 +349,169 @@ class RODPandS():
             if exec_plan_list:
                 ROD_exec_plans[tref_item.Name] = exec_plan_list
 
-        # Generate and evaluate all combinations of ROD execution plans
-        ROD_combinations = [list(chain.from_iterable(combination)) for combination in product(*ROD_exec_plans.values())]
-        print("Total Número de Combinações - Desbastagem:", len(ROD_combinations))
-
-        best_solution, best_objValue = None, 0
-        for data in ROD_combinations:
-            self.generateSolution(data)
-            objValue = self.objFun(self.InitialSolution)
-            if objValue >= best_objValue:
-                best_solution, best_objValue = self.InitialSolution, objValue
-
+        # Generate and evaluate the combinations of ROD execution plans lazily, up to the configured cap
+        max_combinations = get_setting(self.DataHandler, "rod_max_combinations")
+        total_combinations = countCombinations(ROD_exec_plans.values())
+        print("Total Número de Combinações - Desbastagem:", total_combinations)
+        if total_combinations > max_combinations:
+            print(f"Combinações avaliadas - Desbastagem: {max_combinations} (amostra)")
+            ROD_combinations = boundedCombinations(ROD_exec_plans.values(), max_combinations,
+                                                   get_setting(self.DataHandler, "combination_sampling_seed"))
+        else:
+            # Consecutive combinations only change the BoM of one MDW item, so less of the assignment is replayed
+            ROD_combinations = grayCodeCombinations(ROD_exec_plans.values())
+
+        self.MachineObjFun = {}
+        best_solution = best_operations = best_objValue = None
+        for combination in abortable_loop(ROD_combinations, self.user_id, check_interval=50):
+            updated_machines = self.generateSolution(list(chain.from_iterable(combination)))
+            objValue = self.objFun(self.InitialSolution, updated_machines)
+            if best_objValue is None or objValue < best_objValue:
+                # The assignment is updated in place by the next combinations
+                best_solution = {machine: [list(entry) if isinstance(entry, list) else entry for entry in operations]
+                                 for machine, operations in self.InitialSolution.items()}
+                best_operations, best_objValue = dict(self.Operations), objValue
+
+        self.InitialSolution, self.Operations = best_solution, best_operations
         self.DataHandler.RODSolution = best_solution
 
+        # Merge the under-filled batches of machines with Output > 1
+        outputs = {mach.MachineCode: mach.Output for mach in self.Machines if mach.IsActive}
         for machine, operations in self.DataHandler.RODSolution.items():
-            if not operations:
+            if operations and isinstance(operations[0], list):
+                self.DataHandler.RODSolution[machine] = self.packBatches(operations, outputs[machine])
+
+        # Optional improvement of the constructive solution within a fixed time budget
+        time_limit = get_setting(self.DataHandler, "rod_local_search_time")
+        if time_limit and time_limit > 0:
+            self.localSearch(self.DataHandler.RODSolution, time_limit)
+
+        # Share of the winders in use over all batches of each machine, in the final solution
+        self.BatchFillRates = {
+            machine: sum(len(batch) for batch in operations) / (len(operations) * outputs[machine])
+            for machine, operations in self.DataHandler.RODSolution.items()
+            if operations and isinstance(operations[0], list)
+        }
+        if self.BatchFillRates:
+            print("Taxa de enchimento dos lotes - Desbastagem:",
+                  {machine: f"{rate:.0%}" for machine, rate in self.BatchFillRates.items()})
+
+    def packBatches(self, batches, output):
+        '''Merge under-filled batches of the same product, filling earlier batches first.
+        Each product keeps a single open batch, so every reel is placed in O(1). Returns the non-empty batches in order.'''
+        open_batch = {}
+        for batch in batches:
+            if len(batch) >= output:
+                continue
+            item_name = self.Operations[batch[0]].ItemRelated.Name
+            target = open_batch.get(item_name)
+            if target is None:
+                open_batch[item_name] = batch
                 continue
 
-            output = next(mach.Output for mach in self.Machines if mach.IsActive and mach.MachineCode == machine)
-
-            # Only proceed if the machine has multiple batches (i.e., list of lists)
-            if isinstance(operations[0], list):
-                # Collect sublists by product name
-                grouped_by_name = {}
-                for i, op_group in enumerate(operations):
-                    if len(op_group) < output:  # Only consider groups smaller than output
-                        for op in op_group:
-                            data = self.Operations[op]
-                            item_name = data.ItemRelated.Name
-                            if item_name not in grouped_by_name:
-                                grouped_by_name[item_name] = []
-                            grouped_by_name[item_name].append((i, op))  # Store index and operation
-
-                # Now, merge groups of the same product type
-                for item_name, ops in list(grouped_by_name.items()):  # Use list() to allow modifying dict
-                    # Sort by index so that we fill earlier groups first
-                    ops.sort()
-
-                    # Track the group we're currently filling
-                    current_group_index = ops[0][0]
-                    current_group = operations[current_group_index]
-
-                    # Continue merging until all unfilled groups are handled
-                    for idx, op in ops[1:]:  # Start from the second op group onward
-                        if len(current_group) < output:  # Keep filling the current group
-                            # Add the operation to the current group
-                            current_group.append(op)
-                            # Remove the operation from the donor group
-                            operations[idx].remove(op)
-                        else:
-                            current_group_index = idx
-                            current_group = operations[current_group_index]
+            # Move reels into the open batch until it is full; what is left becomes the new open batch
+            moved = min(output - len(target), len(batch))
+            target.extend(batch[:moved])
+            del batch[:moved]
+            if batch:
+                open_batch[item_name] = batch
+
+        return [batch for batch in batches if batch]
+
+    def localSearch(self, solution, time_limit):
+        '''Improve the ROD solution in place with swap, insert and reassign moves until time_limit (seconds) runs out.
+        Only improving moves are kept, and each move only re-evaluates the machines it touches.'''
+        rng = random.Random(get_setting(self.DataHandler, "rod_local_search_seed"))
+        machine_dict = {m.MachineCode: m for m in self.Machines if m.IsActive}
+        machine_values = {machine: self.machineObjFun(machine, operations) for machine, operations in solution.items()}
+        initial_value = current_value = sum(machine_values.values())
+        deadline = tm.time() + time_limit
+        iterations = accepted = 0
+
+        # Stop early once there is no tardiness left to remove
+        while current_value > 0 and tm.time() < deadline:
+            iterations += 1
+            if self.user_id and iterations % 200 == 0:
+                check_abort(self.user_id)
+
+            candidate = self.generateLocalMove(solution, machine_dict, rng)
+            if not candidate:
+                continue
+
+            candidate_values = {machine: self.machineObjFun(machine, operations) for machine, operations in candidate.items()}
+            delta = sum(candidate_values.values()) - sum(machine_values[machine] for machine in candidate)
+            if delta < 0:
+                solution.update(candidate)
+                machine_values.update(candidate_values)
+                current_value += delta
+                accepted += 1
 
-                    # After merging, remove empty groups and ensure no group exceeds output capacity
-                    operations = [group for group in operations if len(group) > 0]
+        # Leave the execution plans with the times of the final solution
+        for machine, operations in solution.items():
+            self.machineObjFun(machine, operations)
+        print(f"Pesquisa local - Desbastagem: {iterations} iterações, {accepted} melhorias, "
+              f"atraso {initial_value:.0f} -> {current_value:.0f} min")
+
+    def generateLocalMove(self, solution, machine_dict, rng):
+        '''Returns the new operation lists of the machines changed by a random move, or None.
+        Entries of machines with Output > 1 are batches (lists of operations), which swap and insert move as a whole.'''
+        machines = [machine for machine, operations in solution.items() if operations]
+        if not machines:
+            return None
+        machine = rng.choice(machines)
+        operations = list(solution[machine])
+        move = rng.random()
+
+        if move < 0.3 and len(operations) > 1:
+            # Swap two entries of the same machine
+            i, j = rng.sample(range(len(operations)), 2)
+            operations[i], operations[j] = operations[j], operations[i]
+            return {machine: operations}
+
+        if move < 0.6 and len(operations) > 1:
+            # Move an entry to another position of the same machine
+            i, j = rng.sample(range(len(operations)), 2)
+            operations.insert(j, operations.pop(i))
+            return {machine: operations}
+
+        # Reassign an operation, taken out of its batch if needed, to another machine or batch
+        i = rng.randrange(len(operations))
+        entry = operations[i]
+        op = rng.choice(entry) if isinstance(entry, list) else entry
+        data = self.Operations[op]
+        targets = [m.MachineCode for m in self.RoutingCache.get(data.ItemRelated.Name, []) if m.MachineCode in solution]
+        if not targets:
+            return None
+        target = rng.choice(targets)
+
+        if isinstance(entry, list):
+            remaining = [op_n for op_n in entry if op_n != op]
+            if remaining:
+                operations[i] = remaining
+            else:
+                operations.pop(i)
+        else:
+            operations.pop(i)
+
+        target_operations = operations if target == machine else list(solution[target])
+        output = machine_dict[target].Output
+        if output > 1:
+            # Join a batch of the same item and production order with free space, else open a new batch
+            open_batches = [idx for idx, batch in enumerate(target_operations)
+                            if isinstance(batch, list) and len(batch) < output and batch is not entry and
+                            self.Operations[batch[0]].ItemRelated.Name == data.ItemRelated.Name and
+                            self.Operations[batch[0]].ProductionOrder.id == data.ProductionOrder.id]
+            if open_batches:
+                idx = rng.choice(open_batches)
+                target_operations[idx] = target_operations[idx] + [op]
+            else:
+                target_operations.insert(rng.randint(0, len(target_operations)), [op])
+        else:
+            target_operations.insert(rng.randint(0, len(target_operations)), op)
 
-                # Update the machine's operations in BestSolution after merging
-                self.DataHandler.RODSolution[machine] = operations
+        if target == machine:
+            return {machine: operations}
+        return {machine: operations, target: target_operations}
 
     def Scheduling(self):
         """Add Starting Time (ST) and Completion Time (CoT) to each Execution Plan using the final solution."""
@@ -319,42 +564,196 @@ class RODPandS():
         for ep_id in plans_to_exclude:
             self.DataHandler.removeEPbyID(ep_id)
 
-    def objFun(self, solution):
-        '''Calculate the objective function value for the given solution. Objective - Minimize tardiness'''
-        objfun_value = 0
+    def objFun(self, solution, updated_machines=None):
+        '''Calculate the objective function value for the given solution. Objective - Minimize tardiness.
+        With updated_machines, only those machines are recalculated and the others keep their last value.'''
         for machine, operations in solution.items():
-            if not operations:
-                continue
-            previous_plan_CoT = self.MachinePreviousPlanCoT[machine][1]
-            previous_type = next((item.MaterialType for item in self.DataHandler.Items if item.Name == self.MachinePreviousPlanCoT[machine][0]), None)
-            previous_item_CoT = None
-            for op in operations:
-                Max_CoT = self.DataHandler.CurrentTime.replace(hour=0, minute=0, second=0, microsecond=0)
-                ops = op if isinstance(op, list) else [op]
-                for op_n in ops:
-                    if op_n in self.Operations:
-                        data = self.Operations[op_n]
-                        current_type = self.getMaterialType(data.ItemRelated.Name)
-                        CT = self.getCycleTime(machine, data.ItemRelated.Name) * data.Quantity
-                        setup_time = self.getSetupTime(previous_type, current_type) if previous_type != current_type else 0.0
-                        self.getSTandCoT(data, CT, previous_plan_CoT, previous_item_CoT, setup_time)
-                        DD = data.ProductionOrder.DD
-                        Tardiness = max(data.CoT - DD, timedelta(0))
-                        Max_CoT = max(Max_CoT, data.CoT)
-                        # objfun_value += (Tardiness.total_seconds() / 60) / data.ProductionOrder.Weight
-                        objfun_value += (Tardiness.total_seconds() / 60)
-                        previous_type = current_type
-                # objfun_value += ((Max_CoT - machine_ST).total_seconds() / 60)
-                previous_item_CoT = Max_CoT
+            if updated_machines is None or machine in updated_machines:
+                self.MachineObjFun[machine] = self.machineObjFun(machine, operations)
+        return sum(self.MachineObjFun[machine] for machine in solution)
+
+    def machineObjFun(self, machine, operations):
+        '''Tardiness of the operations sequenced on a single machine'''
+        if not operations:
+            return 0
+        objfun_value = 0
+        previous_plan_CoT = self.MachinePreviousPlanCoT[machine][1]
+        previous_type = self.ItemMaterialTypeCache.get(self.MachinePreviousPlanCoT[machine][0])
+        previous_item_CoT = None
+        for op in operations:
+            Max_CoT = self.DataHandler.CurrentTime.replace(hour=0, minute=0, second=0, microsecond=0)
+            ops = op if isinstance(op, list) else [op]
+            for op_n in ops:
+                if op_n in self.Operations:
+                    data = self.Operations[op_n]
+                    current_type = self.getMaterialType(data.ItemRelated.Name)
+                    CT = self.getCycleTime(machine, data.ItemRelated.Name) * data.Quantity
+                    setup_time = self.getSetupTime(previous_type, current_type) if previous_type != current_type else 0.0
+                    self.getSTandCoT(data, CT, previous_plan_CoT, previous_item_CoT, setup_time)
+                    DD = data.ProductionOrder.DD
+                    Tardiness = max(data.CoT - DD, timedelta(0))
+                    Max_CoT = max(Max_CoT, data.CoT)
+                    # objfun_value += (Tardiness.total_seconds() / 60) / data.ProductionOrder.Weight
+                    objfun_value += (Tardiness.total_seconds() / 60)
+                    previous_type = current_type
+            # objfun_value += ((Max_CoT - machine_ST).total_seconds() / 60)
+            previous_item_CoT = Max_CoT
 
         return objfun_value
 
 
+class TrefKnapsackModel():
+    """MILP of the Tref knapsack of one combination, built on first use and re-solved every round.
+    There is one variable per (execution plan id, machine index) pair; a round only changes variable bounds,
+    so plans already packed or not allowed in the round are fixed to 0.
+    options holds the solver backend and its limits (see TrefPandS.knapsackOptions) and every solve is
+    recorded in stats."""
+    STATUS_NAMES = {
+        pywraplp.Solver.OPTIMAL: "OPTIMAL", pywraplp.Solver.FEASIBLE: "FEASIBLE",
+        pywraplp.Solver.INFEASIBLE: "INFEASIBLE", pywraplp.Solver.UNBOUNDED: "UNBOUNDED",
+        pywraplp.Solver.ABNORMAL: "ABNORMAL", pywraplp.Solver.MODEL_INVALID: "MODEL_INVALID",
+        pywraplp.Solver.NOT_SOLVED: "NOT_SOLVED",
+    }
+
+    def __init__(self, exec_plan_ids, weights, bin_capacities, output_capacities, coefficients, options=None, stats=None):
+        self.ExecPlanWeights = dict(zip(exec_plan_ids, weights))
+        self.BinCapacities, self.OutputCapacities = bin_capacities, output_capacities
+        self.Coefficients = dict(coefficients)  # (exec plan id, machine index) -> objective coefficient
+        self.Options = options or {"backend": "SCIP", "time_limit": 0, "relative_gap": 0, "threads": 0}
+        self.Stats = stats
+        self.Solver = self.Variables = self.Parameters = None
+
+    def build(self):
+        self.Solver = pywraplp.Solver.CreateSolver(self.Options["backend"])
+        if self.Solver is None:
+            print(f"Solver {self.Options['backend']} indisponível, a usar SCIP")
+            self.Solver = pywraplp.Solver.CreateSolver("SCIP")
+        if self.Options["time_limit"]:
+            self.Solver.SetTimeLimit(int(self.Options["time_limit"] * 1000))
+        if self.Options["threads"]:
+            self.Solver.SetNumThreads(self.Options["threads"])
+        self.Parameters = pywraplp.MPSolverParameters()
+        if self.Options["relative_gap"]:
+            self.Parameters.SetDoubleParam(pywraplp.MPSolverParameters.RELATIVE_MIP_GAP, self.Options["relative_gap"])
+
+        self.Variables = {key: self.Solver.BoolVar(f"x_{key[0]}_{key[1]}") for key in self.Coefficients}
+
+        by_exec_plan, by_bin = defaultdict(list), defaultdict(list)
+        for (ep_id, mach), var in self.Variables.items():
+            by_exec_plan[ep_id].append(var)
+            by_bin[mach].append((ep_id, var))
+
+        for variables in by_exec_plan.values():
+            self.Solver.Add(sum(variables) <= 1)
+        for mach, variables in by_bin.items():
+            self.Solver.Add(sum(var * self.ExecPlanWeights[ep_id] for ep_id, var in variables) <= self.BinCapacities[mach])
+            self.Solver.Add(sum(var for _, var in variables) <= self.OutputCapacities[mach])
+
+        objective = self.Solver.Objective()
+        for key, var in self.Variables.items():
+            objective.SetCoefficient(var, self.Coefficients[key])
+        objective.SetMaximization()
+
+    def solve(self, allowed):
+        """Solve with only the allowed (exec plan id, machine index) pairs free. Returns the packed pairs or None.
+        A feasible packing found within the time limit is accepted."""
+        if self.Solver is None:
+            self.build()
+        for key, var in self.Variables.items():
+            var.SetUb(1 if key in allowed else 0)
+
+        st = tm.time()
+        status = self.Solver.Solve(self.Parameters)
+        if self.Stats is not None:
+            solve_time = tm.time() - st
+            self.Stats["solves"] += 1
+            self.Stats["time"] += solve_time
+            self.Stats["max_time"] = max(self.Stats["max_time"], solve_time)
+            self.Stats["status"][self.STATUS_NAMES.get(status, str(status))] += 1
+
+        if status not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            return None
+        return [key for key in allowed if key in self.Variables and self.Variables[key].solution_value() > 0.5]
+
+class RODTimeline():
+    """Completion times of the ROD reels of every item, per machine of a ROD solution (by its index in the solution).
+    For each (item, machine) it keeps the operation positions holding the item, the cumulative reel count and a
+    sparse table of the latest CoT, so the reels after a cursor are found in logarithmic time (see take)."""
+    def __init__(self, rod_solution, rod_machines, item_names):
+        active_machines = {}
+        for machine in rod_machines:
+            if machine.IsActive:
+                active_machines.setdefault(machine.MachineCode, machine)
+        self.ActiveCount = len([machine for machine in rod_machines if machine.IsActive])
+        self.ItemNames = item_names
+        self.Lengths = [len(operations) for operations in rod_solution.values()]
+        self.Machines = defaultdict(dict)  # item -> {machine object: index in the solution}
+        self.Reels = defaultdict(dict)  # item -> {index in the solution: (positions, cumulative counts, CoT table)}
+
+        for j, (mach_name, operations) in enumerate(rod_solution.items()):
+            item_reels = defaultdict(lambda: ([], [], []))
+            for position, op_pair in enumerate(operations):
+                batch = op_pair if isinstance(op_pair[0], list) else [op_pair]
+                position_reels = defaultdict(list)
+                for op in batch:
+                    position_reels[op[1].ItemRelated.Name].append(op[1].CoT)
+                for item, CoTs in position_reels.items():
+                    positions, cumulative, latest_CoTs = item_reels[item]
+                    positions.append(position)
+                    cumulative.append((cumulative[-1] if cumulative else 0) + len(CoTs))
+                    latest_CoTs.append(max(CoTs))
+
+            for item, (positions, cumulative, latest_CoTs) in item_reels.items():
+                if mach_name in active_machines:
+                    self.Machines[item][active_machines[mach_name]] = j
+                self.Reels[item][j] = (positions, cumulative, self.sparseTable(latest_CoTs))
+
+    @staticmethod
+    def sparseTable(values):
+        table = [values]
+        width = 1
+        while 2 * width <= len(values):
+            previous = table[-1]
+            table.append([max(previous[i], previous[i + width]) for i in range(len(values) - 2 * width + 1)])
+            width *= 2
+        return table
+
+    @staticmethod
+    def rangeMax(table, first, last):
+        level = (last - first + 1).bit_length() - 1
+        return max(table[level][first], table[level][last - (1 << level) + 1])
+
+    def take(self, item, j, cursor, needed):
+        """Take the next needed reels of item on machine j from operation position cursor on.
+        Returns the position after the last operation taken (the end of the machine if there are not enough reels)
+        and the latest CoT of the reels taken, or None if none was taken."""
+        if needed <= 0:
+            return cursor, None
+        positions, cumulative, table = self.Reels[item].get(j, ((), (), None))
+        first = bisect_left(positions, cursor)
+        if first == len(positions):
+            return max(cursor, self.Lengths[j]), None
+
+        last = bisect_left(cumulative, (cumulative[first - 1] if first else 0) + needed)
+        if last == len(positions):
+            return self.Lengths[j], self.rangeMax(table, first, last - 1)
+        return positions[last] + 1, self.rangeMax(table, first, last)
+
 class TrefPandS():
     def __init__(self, DataHandler, user_id=None):
         self.DataHandler = DataHandler
         self.Machines, self.TorcItems, self.TrefItems = self.DataHandler.TrefMachines, self.DataHandler.TorcItems, self.DataHandler.TrefItems
         self.user_id = user_id
+        # Knapsack packings shared by all combinations of the run, see KPMILP
+        self.KnapsackCache, self.KnapsackCacheStats = OrderedDict(), {"hits": 0, "misses": 0}
+        # Number, run time and status of the knapsack MILP solves, see TrefKnapsackModel
+        self.SolveStats = {"solves": 0, "time": 0, "max_time": 0, "status": Counter()}
+        # ROD reel timeline used by calculateTrefST, see rodTimeline
+        self.RODTimeline = None
+        # Time unit loading patterns per (machine, material type and diameter), see machinePatterns
+        self.Patterns = {}
+        # Wins and run time of each Tref engine when they are compared (tref_engine "compare")
+        self.EngineStats = {"heuristic": {"wins": 0, "time": 0}, "cpsat": {"wins": 0, "time": 0}, "ties": 0}
 
     def combineItems(self, combination):
         combined_weights, combined_values, weights_names, weights_PO, exec_plan_ids, type_list = [], [], [], [], [], []
@@ -430,7 +829,7 @@ class TrefPandS():
                                     check_abort(self.user_id)  # Check during execution plan processing
                                 for exec_plan_id in solution["allocated_exec_plans"][machine.MachineCode]:
                                     if exec_plan.id == exec_plan_id:
-                                        timeUnit.ExecutionPlans.append(exec_plan)
+                                        timeUnit.add_execution_plan(exec_plan)
                                         exec_plan.Machine = machine.MachineCode
                                         TUCount += 1
                                         exec_plan.Position = TUCount
@@ -440,72 +839,91 @@ class TrefPandS():
             raise
 
     def Scheduling(self, PT_Settings, rearrange = False):
+        # Last item of each machine and the sort values of every time unit, fetched and computed once per scheduling
+        last_machine_items = self.lastMachineItems() if self.DataHandler.Criteria[2] else {}
+        item_diameters = {}
+        for item in self.DataHandler.Items:
+            item_diameters.setdefault(item.Name, item.Diameter)
+        time_unit_keys = {}
+        need_index = TimeUnit.build_need_index(self.DataHandler.TorcSolution) if rearrange else None
+
+        def time_unit_key(TU):
+            if TU not in time_unit_keys:
+                diameters = [item_diameters[TU_exec_plan.ItemRelated.Name] for TU_exec_plan in TU.ExecutionPlans]
+                time_unit_keys[TU] = {
+                    "need": TU.sort_by_need(self.DataHandler.TorcSolution, need_index) if rearrange else None,
+                    "diameter": TU.get_average_diameter(self.DataHandler.Database),
+                    "min_diameter": min(diameters, default=None),
+                    "max_diameter": max(diameters, default=None),
+                    "material": TU.get_primary_material_type(),
+                    "due_date": TU.calculate_average_due_date(),
+                    "weight": TU.get_average_weight(),
+                }
+            return time_unit_keys[TU]
+
         # Helper function to sort time units based on the configured criteria
         def sort_time_units(TU_list, machine):
             sort_criteria = []
 
             if rearrange:
-                sort_criteria.append(lambda x: x.sort_by_need(self.DataHandler.TorcSolution))
+                sort_criteria.append(lambda x: time_unit_key(x)["need"])
 
             # Append sort criteria based on the enabled criteria
             if self.DataHandler.Criteria[2]:
                 # Check if the we should organize the Time Units in ascending or descending order according to the average diameter
-                with pyodbc.connect(self.DataHandler.ConnectionString) as conn:
-                    with conn.cursor() as cursor:
-                        # Query to get the ExecutionPlan with the biggest CompletionTime for the machine
-                        cursor.execute("""
-                                SELECT TOP 1 po.Item
-                                FROM ProductionOrders po
-                                WHERE Routing = ?
-                                ORDER BY PlannedDeliveryDateTime DESC
-                            """, (machine,))
-                        
-                        """cursor.execute(
-                                SELECT TOP 1 ep.Item
-                                FROM ExecutionPlans ep
-                                WHERE Machine = ?
-                                ORDER BY CompletionTime DESC
-                            , (machine,))"""
+                last_item_dia = item_diameters.get(last_machine_items.get(machine))
 
-                        result = cursor.fetchone()  # Fetch the first result
-                        execution_plan = result[0] if result else None
-
-                max_dia = min_dia = None
-                if execution_plan:
-                    diameters = [Items.get_Item(TU_exec_plan.ItemRelated.Name, self.DataHandler.Database).Diameter
-                                 for TU in TU_list for TU_exec_plan in TU.ExecutionPlans]
-
-                    max_dia, min_dia = max(diameters), min(diameters)
-                    last_item_dia = Items.get_Item(execution_plan, self.DataHandler.Database).Diameter
+                if last_item_dia is not None:
+                    keys = [time_unit_key(TU) for TU in TU_list if TU.ExecutionPlans]
+                    max_dia = max(key["max_diameter"] for key in keys)
+                    min_dia = min(key["min_diameter"] for key in keys)
 
                     if min_dia < last_item_dia < max_dia:
-                        sort_criteria.append(lambda x: -x.get_average_diameter(self.DataHandler.Database)
+                        sort_criteria.append(lambda x: -time_unit_key(x)["diameter"]
                         if (max_dia - last_item_dia) < (last_item_dia - min_dia)
-                        else x.get_average_diameter(self.DataHandler.Database))
+                        else time_unit_key(x)["diameter"])
                     else:
                         sort_criteria.append(lambda
-                                                 x: -x.get_average_diameter(self.DataHandler.Database) if last_item_dia > max_dia or last_item_dia == max_dia else x.get_average_diameter(self.DataHandler.Database))
+                                                 x: -time_unit_key(x)["diameter"] if last_item_dia > max_dia or last_item_dia == max_dia else time_unit_key(x)["diameter"])
                 else:
-                    sort_criteria.append(lambda x: -x.get_average_diameter(self.DataHandler.Database))
+                    sort_criteria.append(lambda x: -time_unit_key(x)["diameter"])
 
             if self.DataHandler.Criteria[4]:
-                sort_criteria.append(lambda x: x.get_primary_material_type())
+                sort_criteria.append(lambda x: time_unit_key(x)["material"])
             # Add average due date as a primary sorting criterion
-            sort_criteria.append(lambda x: x.calculate_average_due_date())
+            sort_criteria.append(lambda x: time_unit_key(x)["due_date"])
 
             # Add weight as a tiebreaker when due dates are the same
-            sort_criteria.append(lambda x: -x.get_average_weight())
+            sort_criteria.append(lambda x: -time_unit_key(x)["weight"])
 
             # Combine all sort criteria into a single sorting key
             key_func = lambda x: tuple(criteria(x) for criteria in sort_criteria)
             return sorted(TU_list, key=key_func) if sort_criteria else TU_list
-        
+
+        # Machine states and routing/setup tables read by TimeUnit.calculate_time
+        self.DataHandler.prefetchSchedulingState()
+
         # Initialize structure
         if PT_Settings:
             self.scheduleWithDependencies(sort_time_units)
         else:
             self.scheduleSimple(sort_time_units)
             
+    def lastMachineItems(self):
+        """Item of the production order with the latest planned delivery of each machine, in a single query"""
+        with pyodbc.connect(self.DataHandler.ConnectionString) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                        SELECT Routing, Item
+                        FROM (
+                            SELECT po.Routing, po.Item,
+                                   ROW_NUMBER() OVER (PARTITION BY po.Routing ORDER BY po.PlannedDeliveryDateTime DESC) AS rn
+                            FROM ProductionOrders po
+                        ) latest
+                        WHERE rn = 1
+                    """)
+                return {machine: item for machine, item in cursor.fetchall()}
+
     def nextShiftStartTime(self, current_time, shift_start_times):
         """Calculate next available shift start time"""
         current_date = current_time.date()
@@ -520,11 +938,8 @@ class TrefPandS():
         for TU_exec_plan in TU.ExecutionPlans:
             if TU_exec_plan.id in exec_plan_dict:
                 exec_plan = exec_plan_dict[TU_exec_plan.id]
-                CT = next(
-                    (routing.CycleTime for routing in self.DataHandler.Routings
-                     if routing.Item == exec_plan.ItemRelated.Name and routing.Machine == TU.Machine),
-                    None)
-                CT = (CT / 1000) * exec_plan.Quantity
+                CT = self.DataHandler.SchedulingTables["cycle"].get((exec_plan.ItemRelated.Name, TU.Machine))
+                CT = CT * exec_plan.Quantity
                 exec_plan.ST = TU.ST
                 exec_plan.CoT = exec_plan.ST + timedelta(minutes=CT)
                 
@@ -546,24 +961,46 @@ class TrefPandS():
             self.update_exec_plan(exec_plan_dict, TU)
 
     def scheduleWithDependencies(self, sort_time_units):
+        """Schedule the machines in the order their first time unit can start given the ROD reels, taking the
+        reels used by each scheduled machine. Machines are kept in a heap by start time; when a machine is
+        scheduled only the machines whose ROD items changed availability are recomputed."""
         ST_TU, item_count_dict = {}, {}
+        self.RODTimeline = None
+
+        TUs_by_machine, boms_by_root = defaultdict(list), defaultdict(list)
+        for tu in self.DataHandler.TimeUnits:
+            TUs_by_machine[tu.Machine].append(tu)
+        for bom in self.DataHandler.BoMs:
+            boms_by_root[bom.ItemRoot].append(bom)
+
+        # Sorted time units and ROD demand of the first time unit of each machine, computed once
+        sorted_TUs, ROD_demand = {}, {}
+        # Inputs and item cursors of the last calculateTrefST call of each machine, to skip unaffected machines
+        last_inputs, last_counts = {}, {}
+        heap, priority, version = [], {}, {}
+
+        def count_key(counts, items):
+            return tuple((item, tuple(counts[item]) if item in counts else None) for item in items)
+
+        def push(machine):
+            version[machine] = version.get(machine, 0) + 1
+            heapq.heappush(heap, (ST_TU[machine][0], priority[machine], version[machine], machine))
 
         # Extract initial CoT for the first time unit in each machine
         for machine in self.Machines:
             if machine.IsActive:
-                TU_list = [tu for tu in self.DataHandler.TimeUnits if machine.MachineCode == tu.Machine]
+                TU_list = TUs_by_machine.get(machine.MachineCode)
                 if not TU_list:
                     continue
 
-                sorted_tu_list = sort_time_units(TU_list, machine.MachineCode)
+                sorted_tu_list = sorted_TUs[machine.MachineCode] = sort_time_units(TU_list, machine.MachineCode)
 
-                ROD_items = {}
+                ROD_items = ROD_demand[machine.MachineCode] = {}
                 for TU_exec_plan in sorted_tu_list[0].ExecutionPlans:
                     qty = TU_exec_plan.ItemRelated.Input
-                    for bom in self.DataHandler.BoMs:
-                        if bom.ItemRoot == TU_exec_plan.ItemRelated.Name:
-                            for BoM_Item in bom.BoMItems:
-                                ROD_items[BoM_Item.ItemRelated] = ROD_items.get(BoM_Item.ItemRelated, 0) + qty
+                    for bom in boms_by_root[TU_exec_plan.ItemRelated.Name]:
+                        for BoM_Item in bom.BoMItems:
+                            ROD_items[BoM_Item.ItemRelated] = ROD_items.get(BoM_Item.ItemRelated, 0) + qty
 
                 Max_CoT, item_count, current_count = self.calculateTrefST(ROD_items, [], {}, self.DataHandler)
                 if item_count:
@@ -572,47 +1009,59 @@ class TrefPandS():
                     ST_TU[machine.MachineCode] = [Max_CoT, None, None] # Case where ROD items don't have any routings, so respective Tref items can start right away
                     
                 item_count_dict[machine.MachineCode] = item_count
+                priority.setdefault(machine.MachineCode, len(priority))
+                push(machine.MachineCode)
                 
         # Determine the order of machines based on their CoT
         order = []
         while ST_TU:
-            # Find the machine with the earliest CoT
-            earliest_machine = min(ST_TU, key=lambda x: ST_TU[x][0])
+            # Find the machine with the earliest CoT, skipping outdated heap entries
+            _, _, entry_version, earliest_machine = heapq.heappop(heap)
+            if earliest_machine not in ST_TU or entry_version != version[earliest_machine]:
+                continue
             order.append((earliest_machine, ST_TU[earliest_machine][0]))
-            previous_count = copy.deepcopy(ST_TU[earliest_machine][2])
-            del ST_TU[earliest_machine]
+            previous_count = ST_TU.pop(earliest_machine)[2]
+            if previous_count is None:
+                continue
 
             # Update CoT_TU for the remaining machines
-            for machine in list(ST_TU.keys()):
-                TU_list = [tu for tu in self.DataHandler.TimeUnits if machine == tu.Machine]
-                if not TU_list or previous_count is None:
+            for machine in ST_TU:
+                ROD_items = ROD_demand[machine]
+                item_count = item_count_dict.get(machine, [])
+                inputs = (count_key(previous_count, ROD_items),
+                          tuple((item, tuple(counts)) for item, counts in item_count.items()) if item_count else None)
+
+                if last_inputs.get(machine) == inputs:
+                    # Same reels available for this machine's items: only carry over the other items' cursors
+                    current_count = dict(previous_count)
+                    current_count.update((item, list(counts)) for item, counts in last_counts[machine].items())
+                    ST_TU[machine][2] = current_count
                     continue
 
-                sorted_tu_list = sort_time_units(TU_list, machine)
-
-                ROD_items = {}
-                for TU_exec_plan in sorted_tu_list[0].ExecutionPlans:
-                    qty = TU_exec_plan.ItemRelated.Input
-                    for bom in self.DataHandler.BoMs:
-                        if bom.ItemRoot == TU_exec_plan.ItemRelated.Name:
-                            for BoM_Item in bom.BoMItems:
-                                ROD_items[BoM_Item.ItemRelated] = ROD_items.get(BoM_Item.ItemRelated, 0) + qty
+                # Only the cursors of this machine's items are updated, the others can be shared
+                current_count = dict(previous_count)
+                for item in ROD_items:
+                    if item in current_count:
+                        current_count[item] = list(current_count[item])
 
                 Max_CoT, updated_item_count, current_count = self.calculateTrefST(
                     ROD_items,
-                    item_count_dict.get(machine, []),
-                    copy.deepcopy(previous_count),
+                    item_count,
+                    current_count,
                     self.DataHandler
                 )
+                last_inputs[machine] = inputs
+                last_counts[machine] = {item: list(current_count[item]) for item in ROD_items if item in current_count}
+                CoT_changed = Max_CoT != ST_TU[machine][0]
                 ST_TU[machine] = [Max_CoT, updated_item_count, current_count]
                 item_count_dict[machine] = updated_item_count
+                if CoT_changed:
+                    push(machine)
         
         # Schedule time units in order
         for machine, start_time in order:
-            TU_list = [tu for tu in self.DataHandler.TimeUnits if machine == tu.Machine]
             previous_TU = None
-            sorted_tu_list = sort_time_units(TU_list, machine)
-            for TU in sorted_tu_list:
+            for TU in sorted_TUs[machine]:
                 TU.calculate_time(start_time, previous_TU, self.DataHandler, self.DataHandler.CurrentTime)
                 previous_TU = TU
 
@@ -624,28 +1073,12 @@ class TrefPandS():
         shift_start_times = [time(0, 0), time(8, 0), time(16, 0)]  # Midnight, 8 AM, 4 PM
         Max_CoT = self.nextShiftStartTime(self.DataHandler.CurrentTime, shift_start_times)
         item_count_aux = {}
+        timeline = self.rodTimeline(data_handler)
+        active_count = timeline.ActiveCount
 
-        for _, (item, qty) in enumerate(ROD_items.items()):
-            machines_with_item = {}
-
-            # Identify machines that contain the item
-            for x, (mach_name, operations) in enumerate(data_handler.RODSolution.items()):
-                for op_pair in operations:
-                    if isinstance(op_pair[0], list):
-                        for op in op_pair:
-                            if op[1].ItemRelated.Name == item:
-                                if mach_name not in machines_with_item:
-                                    mach = next((m for m in self.DataHandler.RODMachines if m.IsActive and m.MachineCode == mach_name), None)
-                                    if mach:
-                                        machines_with_item[mach] = x
-                                        break
-                    else:
-                        if op_pair[1].ItemRelated.Name == item:
-                            if mach_name not in machines_with_item:
-                                mach = next((m for m in self.DataHandler.RODMachines if m.IsActive and m.MachineCode == mach_name), None)
-                                if mach:
-                                    machines_with_item[mach] = x
-                                    break
+        for item, qty in ROD_items.items():
+            # Machines that contain the item
+            machines_with_item = timeline.Machines.get(item)
 
             # Check if any machines were found
             if not machines_with_item:
@@ -670,52 +1103,50 @@ class TrefPandS():
                     for idx in range(remaining_qty):
                         temp_results[idx % len(temp_results)] += 1
 
-                results = [0] * len([machine for machine in self.DataHandler.RODMachines if machine.IsActive])
+                results = [0] * active_count
                 for idx, mach_name in enumerate(machines_with_item.values()):
                     results[mach_name] = temp_results[idx]
 
                 item_count_aux[item] = results
-                current_count[item] = [0] * len([machine for machine in self.DataHandler.RODMachines if machine.IsActive])
-            else:
-                for ROD_item in self.DataHandler.Items:
-                    if item == ROD_item.Name:
-                        current_counts = item_count.get(item, [0] * len([machine for machine in self.DataHandler.RODMachines if machine.IsActive]))
-                        item_count_aux[item] = [y for x, y in enumerate(current_counts)]
-
-            # Process operations for each machine
-            for j, (mach, operations) in enumerate(data_handler.RODSolution.items()):
-                iter = current_count.get(item, [0] * len([machine for machine in self.DataHandler.RODMachines if machine.IsActive]))[j]
-                count = 0
-                while count < item_count_aux.get(item, [])[j] if j < len(item_count_aux.get(item, [])) else 0:
-                    if iter >= len(operations):
-                        break
-                    if isinstance(operations[iter][0], list):
-                        for op_pair in operations[iter]:
-                            if op_pair[1].ItemRelated.Name == item:
-                                count += 1
-                                Max_CoT = max(Max_CoT, op_pair[1].CoT)
-                    else:
-                        if operations[iter][1].ItemRelated.Name == item:
-                            count += 1
-                            Max_CoT = max(Max_CoT, operations[iter][1].CoT)
-                    iter += 1
+                current_count[item] = [0] * active_count
+            elif item in timeline.ItemNames:
+                item_count_aux[item] = list(item_count.get(item, [0] * active_count))
+
+            # Take the next reels of the item from each machine's cursor
+            needed_counts = item_count_aux.get(item, [])
+            cursors = current_count.get(item, [0] * active_count)
+            for j in range(len(timeline.Lengths)):
+                needed = needed_counts[j] if j < len(needed_counts) else 0
+                position, reels_CoT = timeline.take(item, j, cursors[j], needed)
+                if reels_CoT is not None:
+                    Max_CoT = max(Max_CoT, reels_CoT)
                 if item in current_count:
-                    current_count[item][j] = iter
+                    current_count[item][j] = position
 
         return Max_CoT, item_count_aux, current_count
 
+    def rodTimeline(self, data_handler):
+        """ROD reel timeline of the current ROD solution, built once per scheduling"""
+        if self.RODTimeline is None:
+            self.RODTimeline = RODTimeline(data_handler.RODSolution, self.DataHandler.RODMachines,
+                                           {item.Name for item in self.DataHandler.Items})
+        return self.RODTimeline
+
     def execPlanCombinations(self):
         try:
             # Group the Execution Plans by Production Order and generate combinations in batches of 25.
             best_solutions = []
             processed_combinations = 0
             max_no_improvement = 1000  # Stop after 1000 iterations without improvement within a batch
+            max_combinations = get_setting(self.DataHandler, "tref_max_combinations")
+            sampling_seed = get_setting(self.DataHandler, "combination_sampling_seed")
 
             # Sort production orders by due date
             sorted_prod_orders = sorted(self.DataHandler.ProductionOrders, key=lambda po: po.DD)
 
             # Initialize prod_exec_plans as a dictionary
             prod_exec_plans = {}
+            prune_stats = {"alternatives": 0, "equivalent": 0, "dominated": 0}
 
             for prod_order in abortable_loop(sorted_prod_orders, self.user_id, check_interval=10):
                 # Filter execution plans by production order ID and exclude BUN process
@@ -736,10 +1167,15 @@ class TrefPandS():
                     bomid_group = [list(group_by_bomid) for _, group_by_bomid in
                                    groupby(sorted_by_bomid, key=lambda ep: ep.BoMId)]
 
-                    root_ep_list.append(bomid_group)
+                    prune_stats["alternatives"] += len(bomid_group)
+                    root_ep_list.append(self.collapseAlternatives(bomid_group, prune_stats))
 
-                # Store root_ep_list in dictionary with prod_order.id as the key, flattening one level to fit the combination structure
-                prod_exec_plans[prod_order.id] = list(product(*root_ep_list))
+                # Store the BoM alternatives of each root item; combinations are generated lazily per batch
+                prod_exec_plans[prod_order.id] = root_ep_list
+
+            alternative_values = self.alternativeValues()
+            dominance_pruning = get_setting(self.DataHandler, "tref_dominance_pruning")
+            engine = get_setting(self.DataHandler, "tref_engine")
 
             batch_size = 25
             for i in range(0, len(sorted_prod_orders), batch_size):
@@ -763,16 +1199,26 @@ class TrefPandS():
 
                 no_improvement_iterations = 0  # Reset for each batch
 
+                # One choice of BoM per root item of every production order in the batch
+                batch_groups = list(chain.from_iterable(batch_exec_plans.values()))
+                if dominance_pruning:
+                    unpruned_combinations = countCombinations(batch_groups)
+                    batch_groups = self.pruneDominated(batch_groups, alternative_values, prune_stats)
+                    print(f"Espaço de combinações no lote: {unpruned_combinations} -> {countCombinations(batch_groups)}")
+                total_combinations = countCombinations(batch_groups)
+                if total_combinations > max_combinations:
+                    print(f"Combinações no lote: {total_combinations}, avaliadas: {max_combinations} (amostra)")
+
                 # Generate combinations for the current batch
-                for combination in product(*batch_exec_plans.values()):
+                for combination in boundedCombinations(batch_groups, max_combinations, sampling_seed):
                     if self.user_id:
                         check_abort(self.user_id)
                     
                     st = tm.time()
-                    flattened_combination = list(chain.from_iterable(chain.from_iterable(combination)))
+                    flattened_combination = list(chain.from_iterable(combination))
                     # Process the combination and get the according solution, weight and value
-                    current_solution, current_solution_weight, current_solution_value = self.processCombinations(
-                        flattened_combination)
+                    current_solution, current_solution_weight, current_solution_value = self.solveCombination(
+                        flattened_combination, engine)
                     et = tm.time()
                     print(f"Combination processing time: {et - st} seconds")
 
@@ -798,15 +1244,80 @@ class TrefPandS():
                         # print(f"No improvement for {max_no_improvement} iterations, moving to next batch.")
                         break
 
-                best_solutions.append(best_solution)
+                # Batches whose combinations were all infeasible have no solution, their plans are not planned
+                if best_solution is not None:
+                    best_solutions.append(best_solution)
 
             # global total_combinations
             # print(f"Total Número de Combinações - Trefilagem: {total_combinations}")
             print(f"Total Número de Combinações Processadas - Trefilagem: {processed_combinations}")
+            if engine == "compare":
+                print(f"Comparação de motores - Trefilagem: {self.EngineStats}")
+            print(f"Alternativas de BoM - Trefilagem: {prune_stats['alternatives']}, "
+                  f"equivalentes removidas: {prune_stats['equivalent']}, dominadas removidas: {prune_stats['dominated']}")
+            print(f"Resoluções MILP - Trefilagem: {self.SolveStats['solves']} em {self.SolveStats['time']:.2f} segundos "
+                  f"(máx. {self.SolveStats['max_time']:.2f}), estados: {dict(self.SolveStats['status'])}")
+            print(f"Cache de empacotamentos - Trefilagem: {self.KnapsackCacheStats['hits']} reutilizados, "
+                  f"{self.KnapsackCacheStats['misses']} resolvidos")
             return best_solutions
         except AbortedException:
             print("Tref Planning was aborted")
     
+    def routingTables(self):
+        """Cycle time and weight of every item on the active machines that can produce it, by machine code"""
+        active_machines = {machine.MachineCode for machine in self.Machines if machine.IsActive}
+        cycle_times, item_weights = defaultdict(dict), defaultdict(dict)
+        for routing in self.DataHandler.Routings:
+            if routing.Machine in active_machines and routing.CycleTime > 0:
+                cycle_times[routing.Item][routing.Machine] = routing.CycleTime
+                item_weights[routing.Item][routing.Machine] = routing.Weight
+        return cycle_times, item_weights
+
+    def alternativeValues(self):
+        """Lowest and highest knapsack coefficient of every Tref item over the active machines that can produce it"""
+        cycle_times, item_weights = self.routingTables()
+        values = {}
+        for item in self.TrefItems:
+            if item.Name in cycle_times:
+                coefficients = [self.knapsackCoefficient(item.Name, item.Input, machine, cycle_times, item_weights)
+                                for machine in cycle_times[item.Name]]
+                values[item.Name] = (min(coefficients), max(coefficients))
+        return values
+
+    def collapseAlternatives(self, bomid_group, prune_stats):
+        """Keep only the first of the BoM alternatives of a root item with the same multiset of items and quantities"""
+        unique = {}
+        for alternative in bomid_group:
+            key = tuple(sorted((ep.ItemRelated.Name, ep.Quantity) for ep in alternative))
+            unique.setdefault(key, alternative)
+        prune_stats["equivalent"] += len(bomid_group) - len(unique)
+        return list(unique.values())
+
+    def pruneDominated(self, batch_groups, alternative_values, prune_stats):
+        """Drop the BoM alternatives that cannot be part of the best combination of a batch.
+        Every execution plan packs a value between the lowest and highest coefficient of its item, so alternative B
+        is dominated by A of the same root item if A's lowest value exceeds B's highest value by more than the
+        value spread of all the other root items of the batch (see chooseBestSolution)."""
+        # Items without an active Tref routing are never packed, leave batches with them to the search
+        if any(ep.ItemRelated.Name not in alternative_values
+               for group in batch_groups for alternative in group for ep in alternative):
+            return batch_groups
+
+        bounds = [[(sum(alternative_values[ep.ItemRelated.Name][0] for ep in alternative),
+                    sum(alternative_values[ep.ItemRelated.Name][1] for ep in alternative)) for alternative in group]
+                  for group in batch_groups]
+        spreads = [max(upper - lower for lower, upper in group_bounds) for group_bounds in bounds]
+        total_spread = sum(spreads)
+
+        pruned_groups = []
+        for group, group_bounds, spread in zip(batch_groups, bounds, spreads):
+            best_lower = max(lower for lower, _ in group_bounds)
+            margin = total_spread - spread
+            kept = [alternative for alternative, (_, upper) in zip(group, group_bounds) if best_lower - upper <= margin]
+            prune_stats["dominated"] += len(group) - len(kept)
+            pruned_groups.append(kept)
+        return pruned_groups
+
     def processCombinations(self, combination):
         def get_CTs_and_Weights_cache(tref_items, routings, bins, bins_index):
             # Precompute the cycle times and weights
@@ -825,7 +1336,8 @@ class TrefPandS():
 
         current_solution = []
         current_solution_weight, current_solution_value = 0, 0
-        combination_copy = copy.deepcopy(combination)
+        # Execution plans still to be packed, as a bitmask over the indices of combination
+        remaining = (1 << len(combination)) - 1
         
         # Prepare the data structure for bins, weights, etc.
         data = {
@@ -840,7 +1352,7 @@ class TrefPandS():
                 data["output_capacities"].append(machine.Output)
 
         combined_weights, combined_values, weights_names, weights_PO, exec_plan_ids = self.combineItems(
-            combination_copy)
+            combination)
 
         data.update({
             "weights": combined_weights,
@@ -947,11 +1459,24 @@ class TrefPandS():
                     # Update capacity
                     machine_capacity_used[best_machine] += item_type_weights[item_name]
         
+        # Knapsack model shared by every round of this combination, only built if a round needs the MILP
+        knapsack = TrefKnapsackModel(
+            [exec_plan.id for exec_plan in combination],
+            [exec_plan.ItemRelated.Input for exec_plan in combination],
+            data["bin_capacities"], data["output_capacities"], {
+                (exec_plan.id, mach): self.knapsackCoefficient(exec_plan.ItemRelated.Name, exec_plan.ItemRelated.Input,
+                                                               mach, cycle_times, item_weights)
+                for exec_plan in combination
+                for mach, ct in enumerate(cycle_times[exec_plan.ItemRelated.Name]) if ct > 0},
+            self.knapsackOptions(), self.SolveStats)
+
         machine_completion_times = {machine.MachineCode: 0 for machine in self.Machines if machine.IsActive}
+        bin_index = {bin_code: idx for idx, bin_code in enumerate(data["bins"])}
         excluded_machines = set()
         
-        while combination_copy:
-            all_current_items = [exec_plan.ItemRelated.Name for exec_plan in combination_copy]
+        while remaining:
+            remaining_plans = [exec_plan for i, exec_plan in enumerate(combination) if remaining >> i & 1]
+            all_current_items = [exec_plan.ItemRelated.Name for exec_plan in remaining_plans]
             excluded_machines_copy = None
 
             # Backup current exclusions and check if all items are restricted to excluded machines
@@ -980,63 +1505,63 @@ class TrefPandS():
                 excluded_machines.clear()
 
             # Solve with KPMILP using the cached cycle_times and item_weights
-            solution = self.KPMILP(data, cycle_times, item_weights, excluded_machines, item_assignment)
+            solution = self.KPMILP(data, cycle_times, item_weights, excluded_machines, item_assignment, knapsack)
+
+            # Without a packing (no solution within kp_time_limit, or nothing fits) the remaining plans would never
+            # change, so the combination is skipped as infeasible
+            if not solution or not any(solution["allocated_exec_plans"].values()):
+                print(f"Combinação sem empacotamento possível - Trefilagem: {bin(remaining).count('1')} planos por alocar")
+                return [], 0, 0
+
             current_solution.append(solution)
-            if solution:
-                current_solution_weight += solution["total_packed_weight"]
-                current_solution_value += solution["total_objective_value"]
-                
-                for machine, items in solution["individual_weights_names"].items():
-                    for item in items:
-                        if item not in item_assignment:
-                            item_assignment[item] = machine
-
-                # Collect the IDs of items to remove from current combination
-                to_remove = []
-                for exec_plan in combination_copy:
-                    for machine in self.Machines:
-                        if machine.IsActive:
-                            allocated_exec_plans = solution["allocated_exec_plans"][machine.MachineCode]
-                            if exec_plan.id in allocated_exec_plans:
-                                to_remove.append(exec_plan)
-                                # Update machine's completion time
-                                machine_completion_times[machine.MachineCode] += sum(
-                                    cycle_times[exec_plan.ItemRelated.Name][
-                                        data["bins"].index(machine.MachineCode)] * exec_plan.Quantity
-                                    for exec_plan in combination_copy if exec_plan.id in allocated_exec_plans)
-
-                # Temporarily exclude machines exceeding the threshold
-                active_completion_times = [comp_time for comp_time in machine_completion_times.values() if
-                                           comp_time > 0]
-                avg_completion_time = sum(active_completion_times) / len(active_completion_times) \
-                    if active_completion_times else 0
-                for machine_code, comp_time in machine_completion_times.items():
-                    if comp_time > avg_completion_time:
-                        excluded_machines.add(machine_code)
-                    elif machine_code in excluded_machines and comp_time <= avg_completion_time:
-                        excluded_machines.remove(machine_code)
-
-                for exec_plan in to_remove:
-                    combination_copy.remove(exec_plan)
-
-                # Update the data for remaining items
-                combined_weights, combined_values, weights_names, weights_PO, exec_plan_ids = self.combineItems(
-                    combination_copy)
-                data.update({
-                    "weights": combined_weights,
-                    "values": combined_values,
-                    "weights_name": weights_names,
-                    "weights_PO": weights_PO,
-                    "exec_plan_ids": exec_plan_ids
-                })
-                num_items = len(data["weights"])
-                num_bins = len(data["bin_capacities"])
-                data.update({
-                    "num_items": num_items,
-                    "all_items": range(num_items),
-                    "num_bins": num_bins,
-                    "all_bins": range(num_bins)
-                })
+            current_solution_weight += solution["total_packed_weight"]
+            current_solution_value += solution["total_objective_value"]
+            
+            for machine, items in solution["individual_weights_names"].items():
+                for item in items:
+                    if item not in item_assignment:
+                        item_assignment[item] = machine
+
+            # Clear the packed plans from the remaining mask and update the machines' completion times
+            for machine_code, allocated_exec_plans in solution["allocated_exec_plans"].items():
+                allocated_ids = set(allocated_exec_plans)
+                packed = [i for i, exec_plan in enumerate(combination)
+                          if remaining >> i & 1 and exec_plan.id in allocated_ids]
+                machine_time = sum(cycle_times[combination[i].ItemRelated.Name][bin_index[machine_code]] *
+                                   combination[i].Quantity for i in packed)
+                for i in packed:
+                    machine_completion_times[machine_code] += machine_time
+                    remaining &= ~(1 << i)
+
+            # Temporarily exclude machines exceeding the threshold
+            active_completion_times = [comp_time for comp_time in machine_completion_times.values() if
+                                       comp_time > 0]
+            avg_completion_time = sum(active_completion_times) / len(active_completion_times) \
+                if active_completion_times else 0
+            for machine_code, comp_time in machine_completion_times.items():
+                if comp_time > avg_completion_time:
+                    excluded_machines.add(machine_code)
+                elif machine_code in excluded_machines and comp_time <= avg_completion_time:
+                    excluded_machines.remove(machine_code)
+
+            # Update the data for remaining items
+            combined_weights, combined_values, weights_names, weights_PO, exec_plan_ids = self.combineItems(
+                [exec_plan for i, exec_plan in enumerate(combination) if remaining >> i & 1])
+            data.update({
+                "weights": combined_weights,
+                "values": combined_values,
+                "weights_name": weights_names,
+                "weights_PO": weights_PO,
+                "exec_plan_ids": exec_plan_ids
+            })
+            num_items = len(data["weights"])
+            num_bins = len(data["bin_capacities"])
+            data.update({
+                "num_items": num_items,
+                "all_items": range(num_items),
+                "num_bins": num_bins,
+                "all_bins": range(num_bins)
+            })
 
             # Restore original excluded machines list after each KPMILP call
             if excluded_machines_copy:
@@ -1044,16 +1569,18 @@ class TrefPandS():
 
         return current_solution, current_solution_weight, current_solution_value
 
-    def KPMILP(self, data, cycle_times, item_weights, excluded_machines, item_assignment):
-        solver = pywraplp.Solver.CreateSolver("SCIP")
+    def knapsackCoefficient(self, tref_item, item_input, mach, cycle_times, item_weights):
+        """Objective coefficient of packing one execution plan of tref_item in machine index mach"""
+        weight = item_weights[tref_item][mach]
+        return (weight / (cycle_times[tref_item][mach] * 100)) * item_input if self.DataHandler.Criteria[1] else weight
 
-        x = {}
+    def knapsackCandidates(self, data, cycle_times, item_weights, excluded_machines, item_assignment):
+        """Returns the allowed (item index, machine index) pairs of this round and their objective coefficients"""
+        candidates = {}
 
-        # Objective and machine choice cache
-        objective = solver.Objective()
+        # Machine choice cache
         chosen_machines = defaultdict(list)
         machine_diameter_counts = defaultdict(Counter)
-        machine_common_diameter = {}
 
         tref_items_dict = {t.Name: t for t in self.TrefItems}
 
@@ -1071,10 +1598,6 @@ class TrefPandS():
                     if ct > 0: 
                         item_diameter = int(tref_items_dict[tref_item].Diameter * 1000)
                         machine_diameter_counts[mach][item_diameter] += 1
-                        current_most_common = machine_common_diameter.get(mach, None)
-                        if not current_most_common or machine_diameter_counts[mach][item_diameter] > \
-                                machine_diameter_counts[mach][current_most_common]:
-                            machine_common_diameter[mach] = item_diameter
                         chosen_machines[mach].append(i)
             else:
                 # Item not yet assigned, consider all valid machines
@@ -1084,10 +1607,6 @@ class TrefPandS():
                 for mach, ct in enumerate(ct_values):
                     if ct > 0 and data["bins"][mach] not in excluded_machines:
                         machine_diameter_counts[mach][item_diameter] += 1
-                        current_most_common = machine_common_diameter.get(mach, None)
-                        if not current_most_common or machine_diameter_counts[mach][item_diameter] > \
-                                machine_diameter_counts[mach][current_most_common]:
-                            machine_common_diameter[mach] = item_diameter
                         chosen_machines[mach].append(i)
 
         # If no machines chosen due to all items being in excluded machines, temporarily allow them
@@ -1104,10 +1623,6 @@ class TrefPandS():
                         if ct > 0:
                             item_diameter = int(tref_items_dict[tref_item].Diameter * 1000)
                             machine_diameter_counts[mach][item_diameter] += 1
-                            current_most_common = machine_common_diameter.get(mach, None)
-                            if not current_most_common or machine_diameter_counts[mach][item_diameter] > \
-                                    machine_diameter_counts[mach][current_most_common]:
-                                machine_common_diameter[mach] = item_diameter
                             chosen_machines[mach].append(i)
                 else:
                     ct_values = cycle_times[tref_item]
@@ -1115,12 +1630,13 @@ class TrefPandS():
                     for mach, ct in enumerate(ct_values):
                         if ct > 0: 
                             machine_diameter_counts[mach][item_diameter] += 1
-                            current_most_common = machine_common_diameter.get(mach, None)
-                            if not current_most_common or machine_diameter_counts[mach][item_diameter] > \
-                                    machine_diameter_counts[mach][current_most_common]:
-                                machine_common_diameter[mach] = item_diameter
                             chosen_machines[mach].append(i)
 
+        # Most common diameter of each machine, ties go to the smallest diameter so that the choice does not depend
+        # on the order of the items (the knapsack cache key ignores it)
+        machine_common_diameter = {mach: min(counts, key=lambda diameter: (-counts[diameter], diameter))
+                                   for mach, counts in machine_diameter_counts.items()}
+
         # Create variables based on the diameter consistency constraint and item assignments
         for mach, items in chosen_machines.items():
             most_common_diameter = machine_common_diameter[mach]
@@ -1135,49 +1651,494 @@ class TrefPandS():
                     can_assign = (data["bins"][mach] == item_assignment[tref_item])
 
                 if can_assign and item_diameter == most_common_diameter:
-                    # Only create the variable if the diameter is consistent and assignment is allowed
-                    x[item, mach] = solver.BoolVar(f"x_{item}_{mach}")
-                    weight = item_weights[tref_item][mach]
-                    coeff = (weight / (cycle_times[tref_item][mach] * 100)) * data["weights"][item] \
-                        if self.DataHandler.Criteria[1] else weight
-                    objective.SetCoefficient(x[item, mach], coeff)
-
-        # Constraints
+                    # Only consider the pair if the diameter is consistent and assignment is allowed
+                    candidates[item, mach] = self.knapsackCoefficient(data["weights_name"][item], data["weights"][item],
+                                                                      mach, cycle_times, item_weights)
+
+        return candidates
+
+    def KPMILP(self, data, cycle_times, item_weights, excluded_machines, item_assignment, knapsack=None):
+        """Pack one time unit per machine. Easy rounds are solved by a greedy packing that is proven optimal
+        against an upper bound or the LP relaxation; otherwise the MILP is solved, reusing the combination's
+        model (knapsack) if given."""
+        # Rounds with the same remaining items, exclusions and assignments have the same packing
+        signature = self.knapsackSignature(data, excluded_machines, item_assignment)
+        cached = self.KnapsackCache.get(signature, False)
+        if cached is not False:
+            self.KnapsackCache.move_to_end(signature)
+            self.KnapsackCacheStats["hits"] += 1
+            if cached is None:
+                return None
+            packed_names, objective_value = cached
+            return self.knapsackResults(data, self.rehydratePacking(data, packed_names), objective_value)
+        self.KnapsackCacheStats["misses"] += 1
+
+        candidates = self.knapsackCandidates(data, cycle_times, item_weights, excluded_machines, item_assignment)
+
+        selected = None
+        if get_setting(self.DataHandler, "kp_fast_path"):
+            selected = self.fastKnapsack(data, candidates)
+
+        if selected is None:
+            if knapsack is None:
+                knapsack = TrefKnapsackModel(data["exec_plan_ids"], data["weights"], data["bin_capacities"],
+                                             data["output_capacities"], {
+                                                 (data["exec_plan_ids"][i], mach): coeff
+                                                 for (i, mach), coeff in candidates.items()},
+                                             self.knapsackOptions(), self.SolveStats)
+            allowed = {(data["exec_plan_ids"][i], mach): (i, mach) for i, mach in candidates}
+            packed = knapsack.solve(allowed)
+            if packed is None:
+                self.cacheKnapsack(signature, None)
+                return None
+            selected = [allowed[key] for key in packed]
+
+        objective_value = sum(candidates[key] for key in selected)
+        self.cacheKnapsack(signature, ([(data["weights_name"][i], mach) for i, mach in selected], objective_value))
+        return self.knapsackResults(data, selected, objective_value)
+
+    def knapsackOptions(self):
+        """Solver backend and limits of the knapsack MILP for this run"""
+        return {
+            "backend": get_setting(self.DataHandler, "kp_solver"),
+            "time_limit": get_setting(self.DataHandler, "kp_time_limit"),
+            "relative_gap": get_setting(self.DataHandler, "kp_relative_gap"),
+            "threads": get_setting(self.DataHandler, "kp_threads"),
+        }
+
+    def knapsackSignature(self, data, excluded_machines, item_assignment):
+        """Canonical description of a knapsack round: the multiset of (item, Input) to pack, the excluded machines,
+        the machine assigned to each of those items and the active machines with their capacities"""
+        items = Counter(zip(data["weights_name"], data["weights"]))
+        names = {name for name, _ in items}
+        return (
+            tuple(sorted(items.items())),
+            frozenset(excluded_machines),
+            frozenset((name, machine) for name, machine in item_assignment.items() if name in names),
+            tuple(zip(data["bins"], data["bin_capacities"], data["output_capacities"])),
+        )
+
+    def cacheKnapsack(self, signature, packing):
+        """Store a packing (item names per machine index and objective value) with LRU eviction"""
+        self.KnapsackCache[signature] = packing
+        max_size = get_setting(self.DataHandler, "kp_cache_size")
+        while len(self.KnapsackCache) > max_size:
+            self.KnapsackCache.popitem(last=False)
+
+    def rehydratePacking(self, data, packed_names):
+        """Map a cached packing of item names back to (item index, machine index) pairs of this round"""
+        free_indices = defaultdict(list)
         for i in data["all_items"]:
-            solver.Add(sum(x[i, b] for b in data["all_bins"] if (i, b) in x) <= 1)
+            free_indices[data["weights_name"][i]].append(i)
+        for indices in free_indices.values():
+            indices.reverse()
+        return [(free_indices[name].pop(), mach) for name, mach in packed_names]
+
+    def knapsackResults(self, data, selected, objective_value):
+        """Build the solution of a round from the packed (item index, machine index) pairs"""
+        results = {
+            "total_packed_weight": 0,
+            "total_objective_value": objective_value,
+            "individual_weights": {b: [] for b in data["bins"]},
+            "individual_weights_names": {b: [] for b in data["bins"]},
+            "individual_weights_POs": {b: [] for b in data["bins"]},
+            "allocated_exec_plans": {b: [] for b in data["bins"]}
+        }
+
+        packed_by_bin = defaultdict(set)
+        for i, mach in selected:
+            packed_by_bin[mach].add(i)
 
+        for iter, b in enumerate(data["bins"]):
+            bin_weight = 0
+            for i in data["all_items"]:
+                if i in packed_by_bin[iter]:
+                    results["individual_weights"][b].append(data['weights'][i])
+                    results["individual_weights_names"][b].append(data['weights_name'][i])
+                    results["individual_weights_POs"][b].append(data['weights_PO'][i])
+                    bin_weight += data["weights"][i]
+                    results["allocated_exec_plans"][b].append(data["exec_plan_ids"][i])
+            results["total_packed_weight"] += bin_weight
+
+        return results
+
+    def fastKnapsack(self, data, candidates, tolerance=1e-6):
+        """Greedy packing of the candidate pairs, returned only when it is provably optimal:
+        it reaches the sum of the best coefficient of every item, or the value of the LP relaxation
+        (the LP solution is also tried after rounding down). Returns None when the MILP is needed."""
+        if not candidates:
+            return []
+
+        def greedy(fixed):
+            load = defaultdict(float)
+            count = defaultdict(int)
+            packed, packed_items = [], set()
+            for i, mach in fixed:
+                load[mach] += data["weights"][i]
+                count[mach] += 1
+                packed.append((i, mach))
+                packed_items.add(i)
+            # Highest coefficient first, lighter items first on ties
+            for (i, mach), _ in sorted(candidates.items(), key=lambda kv: (-kv[1], data["weights"][kv[0][0]])):
+                if i in packed_items:
+                    continue
+                if (count[mach] < data["output_capacities"][mach] and
+                        load[mach] + data["weights"][i] <= data["bin_capacities"][mach]):
+                    load[mach] += data["weights"][i]
+                    count[mach] += 1
+                    packed.append((i, mach))
+                    packed_items.add(i)
+            return packed, sum(candidates[key] for key in packed)
+
+        packed, value = greedy([])
+
+        best_per_item = {}
+        for (i, _), coeff in candidates.items():
+            best_per_item[i] = max(best_per_item.get(i, coeff), coeff)
+        if value >= sum(best_per_item.values()) - tolerance:
+            return packed
+
+        # LP relaxation bound
+        solver = pywraplp.Solver.CreateSolver("GLOP")
+        if not solver:
+            return None
+        x = {key: solver.NumVar(0, 1, "") for key in candidates}
+        for i in best_per_item:
+            solver.Add(sum(var for (item, _), var in x.items() if item == i) <= 1)
         for b in data["all_bins"]:
-            solver.Add(
-                sum(x[i, b] * data["weights"][i] for i in data["all_items"] if (i, b) in x) <= data["bin_capacities"][
-                    b])
-            solver.Add(sum(x[i, b] for i in data["all_items"] if (i, b) in x) <= data["output_capacities"][b])
-            
-        objective.SetMaximization()
-        status = solver.Solve()
+            bin_vars = [(i, var) for (i, mach), var in x.items() if mach == b]
+            if bin_vars:
+                solver.Add(sum(var * data["weights"][i] for i, var in bin_vars) <= data["bin_capacities"][b])
+                solver.Add(sum(var for _, var in bin_vars) <= data["output_capacities"][b])
+        solver.Maximize(sum(coeff * x[key] for key, coeff in candidates.items()))
+        if solver.Solve() != pywraplp.Solver.OPTIMAL:
+            return None
+
+        lp_value = solver.Objective().Value()
+        if value >= lp_value - tolerance:
+            return packed
+
+        # Round the LP solution down and complete it greedily
+        rounded, rounded_value = greedy([key for key, var in x.items() if var.solution_value() > 1 - tolerance])
+        if rounded_value >= lp_value - tolerance:
+            return rounded
+        return None
 
-        if status == pywraplp.Solver.OPTIMAL:
+    def solveCombination(self, combination, engine):
+        """Pack a combination with the selected Tref engine: the round by round knapsack heuristic ("heuristic"),
+        the global CP-SAT model ("cpsat"), the time unit pattern MILP ("patterns") or the heuristic and CP-SAT,
+        keeping the better solution ("compare"). The exact engines fall back to the heuristic without a solution."""
+        engines = {"cpsat": self.cpsatCombination, "patterns": self.patternCombination}
+        if engine in engines:
+            result = engines[engine](combination)
+            return result if result is not None else self.processCombinations(combination)
+        if engine == "heuristic":
+            return self.processCombinations(combination)
+        if engine != "compare":
+            raise ValueError(f"Unknown Tref engine {engine!r}, expected one of "
+                             f"{['heuristic', *engines, 'compare']}")
+
+        st = tm.time()
+        heuristic_result = self.processCombinations(combination)
+        self.EngineStats["heuristic"]["time"] += tm.time() - st
+        st = tm.time()
+        cpsat_result = self.cpsatCombination(combination)
+        self.EngineStats["cpsat"]["time"] += tm.time() - st
+        if cpsat_result is None:
+            self.EngineStats["heuristic"]["wins"] += 1
+            return heuristic_result
+
+        (heuristic_solution, heuristic_weight, heuristic_value), (cpsat_solution, cpsat_weight, cpsat_value) = \
+            heuristic_result, cpsat_result
+        print(f"Heurística: valor {heuristic_value:.6f}, {len(heuristic_solution)} rondas | "
+              f"CP-SAT: valor {cpsat_value:.6f}, {len(cpsat_solution)} rondas")
+        if self.chooseBestSolution(cpsat_weight, cpsat_value, len(cpsat_solution),
+                                   heuristic_weight, heuristic_value, len(heuristic_solution)):
+            self.EngineStats["cpsat"]["wins"] += 1
+            return cpsat_result
+        if self.chooseBestSolution(heuristic_weight, heuristic_value, len(heuristic_solution),
+                                   cpsat_weight, cpsat_value, len(cpsat_solution)):
+            self.EngineStats["heuristic"]["wins"] += 1
+        else:
+            self.EngineStats["ties"] += 1
+        return heuristic_result
+
+    def cpsatCombination(self, combination):
+        """Pack the MDW execution plans of a combination into time units with a single CP-SAT model.
+        Each machine gets time units (slots) of a single diameter and material type holding at most Input weight and
+        Output plans, and every item runs on one machine. As in KPMILP, a plan is packed at most once. The packed
+        value is maximized first and the number of time units minimized second. Returns (solution, weight, value)
+        in the format of processCombinations, with one round per time unit of each machine, or None if no solution
+        is found."""
+        active_machines = [machine for machine in self.Machines if machine.IsActive]
+        bins = [machine.MachineCode for machine in active_machines]
+        cycle_times, item_weights = self.routingTables()
+
+        eligible = {exec_plan.id: [mach for mach, code in enumerate(bins) if code in cycle_times[exec_plan.ItemRelated.Name]]
+                    for exec_plan in combination}
+        if not combination or not all(eligible.values()):
+            return None
+
+        coefficients = {
+            (exec_plan.id, mach): self.knapsackCoefficient(exec_plan.ItemRelated.Name, exec_plan.ItemRelated.Input,
+                                                           bins[mach], cycle_times, item_weights)
+            for exec_plan in combination for mach in eligible[exec_plan.id]}
+        # CP-SAT only takes integers: coefficients are scaled so that the packed value dominates the time unit count
+        scale = 10 ** 6 / (max(coefficients.values()) or 1)
+        weight_scale = 1000
+        classes = {exec_plan.id: (exec_plan.ItemRelated.MaterialType, int(exec_plan.ItemRelated.Diameter * 1000))
+                   for exec_plan in combination}
+
+        # Slots of each machine and class, as many as a first fit decreasing packing of all the eligible plans of the
+        # class uses: the best solution never needs more, since the time units it packs are minimized
+        class_weights = defaultdict(list)
+        for exec_plan in combination:
+            for mach in eligible[exec_plan.id]:
+                class_weights[mach, classes[exec_plan.id]].append(round(exec_plan.ItemRelated.Input * weight_scale))
+        slots = {(mach, cls): range(self.firstFitSlots(weights, round(active_machines[mach].Input * weight_scale),
+                                                       active_machines[mach].Output))
+                 for (mach, cls), weights in class_weights.items()}
+
+        model = cp_model.CpModel()
+        assign = {}
+        for exec_plan in combination:
+            for mach in eligible[exec_plan.id]:
+                key = (exec_plan.ItemRelated.Name, mach)
+                if key not in assign:
+                    assign[key] = model.NewBoolVar(f"a_{key[0]}_{mach}")
+        for item_name in {exec_plan.ItemRelated.Name for exec_plan in combination}:
+            model.AddExactlyOne(var for (name, _), var in assign.items() if name == item_name)
+
+        x = {}
+        by_slot = defaultdict(list)
+        for exec_plan in combination:
+            cls = classes[exec_plan.id]
+            for mach in eligible[exec_plan.id]:
+                for t in slots[mach, cls]:
+                    x[exec_plan.id, mach, cls, t] = model.NewBoolVar(f"x_{exec_plan.id}_{mach}_{t}")
+                    by_slot[mach, cls, t].append(exec_plan)
+                model.Add(sum(x[exec_plan.id, mach, cls, t] for t in slots[mach, cls]) <= assign[exec_plan.ItemRelated.Name, mach])
+            model.AddAtMostOne(x[exec_plan.id, mach, cls, t] for mach in eligible[exec_plan.id] for t in slots[mach, cls])
+
+        used = {}
+        for (mach, cls), class_slots in slots.items():
+            machine = active_machines[mach]
+            for t in class_slots:
+                used[mach, cls, t] = model.NewBoolVar(f"u_{mach}_{cls}_{t}")
+                exec_plans = by_slot[mach, cls, t]
+                model.Add(sum(round(exec_plan.ItemRelated.Input * weight_scale) * x[exec_plan.id, mach, cls, t]
+                              for exec_plan in exec_plans) <= round(machine.Input * weight_scale) * used[mach, cls, t])
+                model.Add(sum(x[exec_plan.id, mach, cls, t] for exec_plan in exec_plans) <= machine.Output * used[mach, cls, t])
+                if t > 0:
+                    model.AddImplication(used[mach, cls, t], used[mach, cls, t - 1])
+
+        model.Maximize(sum(round(coefficients[ep_id, mach] * scale) * var for (ep_id, mach, _, _), var in x.items())
+                       - sum(used.values()))
+
+        solver = cp_model.CpSolver()
+        solver.parameters.max_time_in_seconds = get_setting(self.DataHandler, "tref_cpsat_time_limit")
+        solver.parameters.num_workers = get_setting(self.DataHandler, "tref_cpsat_workers")
+        status = solver.Solve(model)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            print(f"CP-SAT sem solução - Trefilagem: {solver.StatusName(status)}")
+            return None
+
+        # The used time units of each machine are its rounds, in slot order
+        slot_rounds, machine_rounds = {}, defaultdict(int)
+        for slot, is_used in used.items():
+            if solver.BooleanValue(is_used):
+                slot_rounds[slot] = machine_rounds[slot[0]]
+                machine_rounds[slot[0]] += 1
+
+        rounds = defaultdict(lambda: {code: [] for code in bins})
+        for (ep_id, mach, cls, t), var in x.items():
+            if solver.BooleanValue(var):
+                rounds[slot_rounds[mach, cls, t]][bins[mach]].append(ep_id)
+        exec_plans = {exec_plan.id: exec_plan for exec_plan in combination}
+        rounds = [{code: [exec_plans[ep_id] for ep_id in sorted(ep_ids, key=list(exec_plans).index)]
+                   for code, ep_ids in rounds[r].items()} for r in sorted(rounds)]
+
+        return self.roundsSolution(bins, rounds, coefficients)
+
+    @staticmethod
+    def firstFitSlots(weights, capacity, max_count):
+        """Number of time units of capacity weight and max_count plans that first fit decreasing packs the weights in.
+        Weights above the capacity are left out."""
+        loads = []
+        for weight in sorted(weights, reverse=True):
+            if weight > capacity:
+                continue
+            for k, (load, count) in enumerate(loads):
+                if load + weight <= capacity and count < max_count:
+                    loads[k] = (load + weight, count + 1)
+                    break
+            else:
+                loads.append((weight, 1))
+        return len(loads)
+
+    def roundsSolution(self, bins, rounds, coefficients):
+        """Build (solution, weight, value) in the format of processCombinations from the execution plans packed
+        per machine code in every round"""
+        current_solution, current_solution_weight, current_solution_value = [], 0, 0
+        for round_plans in rounds:
             results = {
                 "total_packed_weight": 0,
-                "total_objective_value": objective.Value(),
-                "individual_weights": {b: [] for b in data["bins"]},
-                "individual_weights_names": {b: [] for b in data["bins"]},
-                "individual_weights_POs": {b: [] for b in data["bins"]},
-                "allocated_exec_plans": {b: [] for b in data["bins"]}
+                "total_objective_value": 0,
+                "individual_weights": {b: [] for b in bins},
+                "individual_weights_names": {b: [] for b in bins},
+                "individual_weights_POs": {b: [] for b in bins},
+                "allocated_exec_plans": {b: [] for b in bins}
             }
+            for mach, b in enumerate(bins):
+                for exec_plan in round_plans[b]:
+                    results["individual_weights"][b].append(exec_plan.ItemRelated.Input)
+                    results["individual_weights_names"][b].append(exec_plan.ItemRelated.Name)
+                    results["individual_weights_POs"][b].append(exec_plan.ProductionOrder)
+                    results["allocated_exec_plans"][b].append(exec_plan.id)
+                    results["total_packed_weight"] += exec_plan.ItemRelated.Input
+                    results["total_objective_value"] += coefficients[exec_plan.id, mach]
+            current_solution.append(results)
+            current_solution_weight += results["total_packed_weight"]
+            current_solution_value += results["total_objective_value"]
 
-            for iter, b in enumerate(data["bins"]):
-                bin_weight = 0
-                for i in data["all_items"]:
-                    if (i, iter) in x and x[i, iter].solution_value() > 0:
-                        results["individual_weights"][b].append(data['weights'][i])
-                        results["individual_weights_names"][b].append(data['weights_name'][i])
-                        results["individual_weights_POs"][b].append(data['weights_PO'][i])
-                        bin_weight += data["weights"][i]
-                        results["allocated_exec_plans"][b].append(data["exec_plan_ids"][i])
-                results["total_packed_weight"] += bin_weight
-                
-            return results
-        return None
+        return current_solution, current_solution_weight, current_solution_value
+
+    def machinePatterns(self, machine, item_class, cycle_times):
+        """Feasible loadings of a time unit of machine with the Tref items of item_class (material type, diameter):
+        multisets of items, as (item name, count) tuples, with at most Output plans and Input weight.
+        Enumerated once per run; None if there are more than tref_max_patterns."""
+        key = (machine.MachineCode, item_class)
+        if key in self.Patterns:
+            return self.Patterns[key]
+
+        items = sorted((item.Name, item.Input) for item in self.TrefItems
+                       if (item.MaterialType, int(item.Diameter * 1000)) == item_class
+                       and machine.MachineCode in cycle_times[item.Name])
+        max_patterns = get_setting(self.DataHandler, "tref_max_patterns")
+        patterns = []
+
+        def extend(start, pattern, count, weight):
+            if len(patterns) > max_patterns:
+                return
+            if pattern:
+                patterns.append(tuple(Counter(pattern).items()))
+            if count == machine.Output:
+                return
+            for i in range(start, len(items)):
+                name, item_input = items[i]
+                if weight + item_input <= machine.Input:
+                    extend(i, pattern + [name], count + 1, weight + item_input)
+
+        extend(0, [], 0, 0)
+        self.Patterns[key] = patterns if len(patterns) <= max_patterns else None
+        return self.Patterns[key]
+
+    def patternCombination(self, combination):
+        """Pack the MDW execution plans of a combination by choosing how many time units of each loading pattern
+        (see machinePatterns) every machine runs, cutting stock style. The pattern counts must produce exactly the
+        plans of the combination and every item runs on one machine. The packed value is maximized first and the
+        number of time units minimized second. Returns (solution, weight, value) in the format of
+        processCombinations, or None if there are too many patterns or no solution is found."""
+        active_machines = [machine for machine in self.Machines if machine.IsActive]
+        bins = [machine.MachineCode for machine in active_machines]
+        cycle_times, item_weights = self.routingTables()
+
+        demand = Counter(exec_plan.ItemRelated.Name for exec_plan in combination)
+        item_data = {exec_plan.ItemRelated.Name: exec_plan.ItemRelated for exec_plan in combination}
+        if not combination or any(not cycle_times[name] for name in demand):
+            return None
+
+        # Patterns of every machine that only use items of the combination, within their demand
+        patterns = []
+        for mach, machine in enumerate(active_machines):
+            classes = {(item.MaterialType, int(item.Diameter * 1000)) for item in item_data.values()
+                       if machine.MachineCode in cycle_times[item.Name]}
+            for item_class in sorted(classes):
+                machine_patterns = self.machinePatterns(machine, item_class, cycle_times)
+                if machine_patterns is None:
+                    print(f"Demasiados padrões - Trefilagem: {machine.MachineCode} {item_class}")
+                    return None
+                patterns.extend((mach, pattern) for pattern in machine_patterns
+                                if all(demand[name] >= count for name, count in pattern))
+
+        solver = pywraplp.Solver.CreateSolver("SCIP")
+        counts = [solver.IntVar(0, solver.infinity(), f"n_{p}") for p in range(len(patterns))]
+        assign = {(name, mach): solver.BoolVar(f"a_{name}_{mach}")
+                  for name in demand for mach, code in enumerate(bins) if code in cycle_times[name]}
+
+        for name, quantity in demand.items():
+            solver.Add(sum(var for (item_name, _), var in assign.items() if item_name == name) == 1)
+            solver.Add(sum(count * counts[p] for p, (_, pattern) in enumerate(patterns)
+                           for item_name, count in pattern if item_name == name) == quantity)
+        for p, (mach, pattern) in enumerate(patterns):
+            for name, _ in pattern:
+                solver.Add(counts[p] <= demand[name] * assign[name, mach])
+
+        item_values = {key: self.knapsackCoefficient(key[0], item_data[key[0]].Input, bins[key[1]], cycle_times,
+                                                     item_weights) for key in assign}
+        value = sum(demand[name] * item_values[name, mach] * var for (name, mach), var in assign.items())
+        solver.Maximize(value)
+        if solver.Solve() not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            return None
+
+        # Second stage: fewest time units that keep the best packed value
+        best_value = solver.Objective().Value()
+        solver.Add(value >= best_value - 1e-6 * max(1, abs(best_value)))
+        solver.Minimize(sum(counts))
+        if solver.Solve() not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            return None
+
+        # Expand the pattern counts into time units, taking the plans of each item in combination order
+        remaining = defaultdict(list)
+        for exec_plan in reversed(combination):
+            remaining[exec_plan.ItemRelated.Name].append(exec_plan)
+        time_units = defaultdict(list)
+        for p, (mach, pattern) in enumerate(patterns):
+            for _ in range(round(counts[p].solution_value())):
+                time_units[mach].append([remaining[name].pop() for name, count in pattern for _ in range(count)])
+
+        rounds = [{code: [] for code in bins} for _ in range(max(map(len, time_units.values())))]
+        for mach, machine_time_units in time_units.items():
+            for t, exec_plans in enumerate(machine_time_units):
+                rounds[t][bins[mach]] = exec_plans
+
+        coefficients = {(exec_plan.id, mach): item_values[exec_plan.ItemRelated.Name, mach]
+                        for exec_plan in combination for mach in range(len(bins))
+                        if (exec_plan.ItemRelated.Name, mach) in item_values}
+        return self.roundsSolution(bins, rounds, coefficients)
+
+# Long-lived pool of parallel tempering worker processes, shared by all runs of the server
+TORC_POOL = None
+TORC_POOL_LOCK = threading.Lock()
+TORC_RUN_KEYS = itertools.count()
+
+# Torc engine of a worker process and the run it was built for
+TORC_ENGINE = TORC_ENGINE_KEY = None
+
+# Data the parallel tempering chains need, the worker engines are built from it without the DataHandler
+TORC_CHAIN_DATA = ("Operations", "OperationIds", "RoutingCache", "MachinePreviousPlanCoT", "SetupTimesCache",
+                   "CycleTimesCache", "MaterialTypeCache", "TrefCoTCache", "DayStart")
+
+def startTorcWorkers():
+    """Return the pool of parallel tempering workers, one per CPU, creating it on first call (at server start).
+    The workers are spawned rather than forked from the threaded server, and are kept for the following runs."""
+    global TORC_POOL
+    with TORC_POOL_LOCK:
+        if TORC_POOL is None:
+            TORC_POOL = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return TORC_POOL
+
+def runTorcChain(args):
+    """Run one chain in a worker process. The engine is rebuilt from the pickled chain data only when the task
+    belongs to a different run than the previous one."""
+    global TORC_ENGINE, TORC_ENGINE_KEY
+    run_key, chain_data, *chain_args = args
+    if run_key != TORC_ENGINE_KEY:
+        TORC_ENGINE = TorcPandS.__new__(TorcPandS)
+        TORC_ENGINE.__dict__.update(pickle.loads(chain_data))
+        TORC_ENGINE_KEY = run_key
+    return TORC_ENGINE.runChain(*chain_args)
 
 class TorcPandS():
     def __init__(self, DataHandler, user_id=None):
@@ -1192,13 +2153,16 @@ class TorcPandS():
         # Cache frequently accessed data for performance
         self._init_caches()
         
-        # Initialize solution tracking
+        # Initialize solution tracking. MachineObjFun keeps, per machine, the tardiness, early completion and the
+        # operation ids and state (ST, CoT, material type, item, running sums) at each position of its last evaluation
         self.MachinePreviousPlanCoT, self.MachineObjFun = {}, {}
         self.InitialSolution, self.Operations = self.generateInitialSolution()
+        self.InitialSequences = {machine: [op for op, _ in ops] for machine, ops in self.InitialSolution.items()}
+        self.OperationIds = list(self.Operations.keys())
         self.Check = False
         
         # Run optimization
-        self.LateOrders = self.simulatedAnnealing()
+        self.LateOrders = self.optimize()
 
     def cacheSetupTimes(self):
         """Cache setup times as a dictionary for faster lookups."""
@@ -1247,6 +2211,17 @@ class TorcPandS():
             if routing.Machine in machine_dict:
                 self.RoutingCache[routing.Item].append(machine_dict[routing.Machine])
 
+        # Latest Tref time unit completion of each production order
+        self.TrefCoTCache = {}
+        for tu in self.DataHandler.TimeUnits:
+            for exec_plan in tu.ExecutionPlans:
+                prod_order_id = exec_plan.ProductionOrder.id
+                if prod_order_id not in self.TrefCoTCache or tu.CoT > self.TrefCoTCache[prod_order_id]:
+                    self.TrefCoTCache[prod_order_id] = tu.CoT
+
+        # Start time of production orders without Tref time units
+        self.DayStart = self.DataHandler.CurrentTime.replace(hour=0, minute=0, second=0, microsecond=0)
+
     def getSetupTime(self, prev_type, cur_type):
         return self.SetupTimesCache.get((prev_type, cur_type), 0.0)
 
@@ -1340,10 +2315,9 @@ class TorcPandS():
 
         else:
             # Find latest completion time from time units
-            tref_latest_CoT = max(
-                (tu.CoT for tu in self.DataHandler.TimeUnits for exec_plan in tu.ExecutionPlans
-                if prod_order_id == exec_plan.ProductionOrder.id), default=self.DataHandler.CurrentTime.replace(hour=0, minute=0, second=0, microsecond=0)
-            )
+            tref_latest_CoT = self.TrefCoTCache.get(prod_order_id)
+            if tref_latest_CoT is None:
+                tref_latest_CoT = self.DayStart
     
         return (max(tref_latest_CoT, previous_plan_CoT or datetime.min, 
                    previous_item_CoT or datetime.min), used_eps, tref_item_CoT)
@@ -1543,21 +2517,36 @@ class TorcPandS():
 
         def calculate_machine_objfun(machine, operations):
             if not operations:
-                return 0, 0
-                
-            tardiness_value = 0
-            early_completion_value = 0
+                return 0, 0, None
+
+            # Operations before the first position that differs from the last evaluation of this machine keep
+            # their times, so the evaluation resumes from the state cached at that position
+            cached = self.MachineObjFun.get(machine)
+            cached_ops, cached_states = cached[2] if cached and cached[2] else ([], [])
+            start, limit = 0, min(len(cached_ops), len(operations))
+            while start < limit and operations[start][0] == cached_ops[start]:
+                start += 1
+            op_ids, states = cached_ops[:start], cached_states[:start]
+            for (_, data), (ST, CoT, *_) in zip(operations[:start], states):
+                data[2], data[3] = ST, CoT
+
             alternation_penalty = 0
             used_eps = []
             tref_item_CoT = {}
             
-            # Get initial state
-            previous_item = self.MachinePreviousPlanCoT[machine][0]
-            previous_type = self.MaterialTypeCache.get(previous_item) if previous_item else None
-            previous_item_CoT = None
-            last_item_name = None
+            if start:
+                _, previous_item_CoT, previous_type, last_item_name, tardiness_value, early_completion_value = states[-1]
+            else:
+                tardiness_value = 0
+                early_completion_value = 0
+
+                # Get initial state
+                previous_item = self.MachinePreviousPlanCoT[machine][0]
+                previous_type = self.MaterialTypeCache.get(previous_item) if previous_item else None
+                previous_item_CoT = None
+                last_item_name = None
 
-            for _, data in operations:
+            for op, data in operations[start:]:
                 current_item_name = data[1].ItemRelated.Name
                 
                 # Calculate times
@@ -1595,8 +2584,10 @@ class TorcPandS():
                 data[2], data[3] = ST, CoT
                 last_item_name = current_item_name
                 previous_item_CoT, previous_type = CoT, current_type
+                op_ids.append(op)
+                states.append((ST, CoT, current_type, current_item_name, tardiness_value, early_completion_value))
 
-            return tardiness_value, early_completion_value
+            return tardiness_value, early_completion_value, (op_ids, states)
 
         if updated_machines is None:
             #total_tardiness_value = 0
@@ -1604,8 +2595,8 @@ class TorcPandS():
             #total_alternation_penalty = 0
             
             for machine, operations in solution.items():
-                tardiness, early_completion = calculate_machine_objfun(machine, operations)
-                self.MachineObjFun[machine] = (tardiness, early_completion)
+                tardiness, early_completion, prefix = calculate_machine_objfun(machine, operations)
+                self.MachineObjFun[machine] = (tardiness, early_completion, prefix)
                 weights['tardiness'] += tardiness
                 weights['early_completion'] += early_completion    
                 #total_tardiness_value += tardiness
@@ -1623,8 +2614,8 @@ class TorcPandS():
         )
         
         for machine in updated_machines:
-            tardiness, early_completion = calculate_machine_objfun(machine, solution[machine])
-            machineObjFunValue[machine] = (tardiness, early_completion)
+            tardiness, early_completion, prefix = calculate_machine_objfun(machine, solution[machine])
+            machineObjFunValue[machine] = (tardiness, early_completion, prefix)
             weights['tardiness'] += tardiness
             weights['early_completion'] += early_completion    
             #total_tardiness_value += tardiness
@@ -1632,12 +2623,15 @@ class TorcPandS():
 
         return weights, machineObjFunValue
 
+    def indexPositions(self, solution):
+        """Map every operation of the solution to its (machine, index) and start an empty undo log"""
+        self.OpPositions = {op: (machine, i) for machine, ops in solution.items() for i, (op, _) in enumerate(ops)}
+        self.UndoLog = []
+
     def machineMove(self, solution, op1, op2):
         '''Takes a solution dictionary, machine, and two operations op1, op2.
-        Returns a new solution with op1 and op2 swapped within the same machine.
+        Swaps op1 and op2 in place when they are on the same machine and returns the solution and that machine.
         '''
-        solution_aux = {k: list(v) for k, v in solution.items()}
-
         def check_adjacent_items(op_index, operations):
             if 0 < op_index < len(operations) - 1:
                 # Check if current and adjacent items have the same name
@@ -1649,74 +2643,180 @@ class TorcPandS():
                 return len(set(item_names)) == 1
             return False
 
-        # Find the machine containing both operations
-        for machine, operations in solution.items():
-            if not operations:
-                continue
-            
-            # Find indices of both operations
-            indices = [i for i, op in enumerate(operations) if op[0] in (op1, op2)]
-            
-            if len(indices) == 2:
-                op1_idx, op2_idx = indices
+        # Both operations must be on the same machine
+        if op1 not in self.OpPositions or op2 not in self.OpPositions:
+            return solution, None
+        machine, op1_idx = self.OpPositions[op1]
+        op2_machine, op2_idx = self.OpPositions[op2]
+        if machine != op2_machine:
+            return solution, None
+        operations = solution[machine]
                 
-                # Avoid alternation if adjacent items are identical
-                if check_adjacent_items(op1_idx, operations) or check_adjacent_items(op2_idx, operations):
-                    return solution, None
-
-                # Perform the swap
-                solution_aux[machine][op1_idx], solution_aux[machine][op2_idx] = (
-                    solution_aux[machine][op2_idx],
-                    solution_aux[machine][op1_idx],
-                )
-                return solution_aux, machine
-        return solution, None
+        # Avoid alternation if adjacent items are identical
+        if check_adjacent_items(op1_idx, operations) or check_adjacent_items(op2_idx, operations):
+            return solution, None
+
+        # Perform the swap
+        operations[op1_idx], operations[op2_idx] = operations[op2_idx], operations[op1_idx]
+        self.OpPositions[op1], self.OpPositions[op2] = (machine, op2_idx), (machine, op1_idx)
+        self.UndoLog.append(("move", machine, op1_idx, op2_idx))
+        return solution, machine
 
     def machineSwitch(self, solution, op, machine):
         '''Takes a solution dictionary, operation, and machine.
-        Returns a new solution with the operation assigned to the specified machine.
+        Moves the operation in place to the end of the specified machine and returns the solution and its previous machine.
         '''
-        solution_aux = {k: list(v) for k, v in solution.items()}
-        
         # Find the machine containing the operation
-        current_machine = next((m for m, ops in solution.items() if any(o[0] == op for o in ops)), None)
+        current_machine = self.OpPositions.get(op, (None, None))[0]
 
         # If the current machine is the same as the chosen one, we can't make the switch
         if machine.MachineCode == current_machine:
             return solution, None
 
-        # Remove the operation from its current machine
-        operation = next(o for o in solution[current_machine] if o[0] == op)
-        solution_aux[current_machine].remove(operation)
-
         # Assign the operation to the specified machine at the end of its list
-        solution_aux[machine.MachineCode].append(operation)
+        self.machineInsert(solution, op, machine.MachineCode, len(solution[machine.MachineCode]))
+
+        return solution, current_machine
+
+    def machineInsert(self, solution, op, machine, index):
+        """Move the operation in place to the given index of a machine. Returns the solution and the changed machines."""
+        current_machine, op_idx = self.OpPositions[op]
+        if current_machine == machine and op_idx == index:
+            return solution, []
+
+        operation = solution[current_machine].pop(op_idx)
+        solution[machine].insert(index, operation)
+        self.reindexPositions(solution, current_machine, op_idx)
+        self.reindexPositions(solution, machine, index)
+        self.UndoLog.append(("insert", current_machine, op_idx, machine, index))
+
+        return solution, [current_machine] if current_machine == machine else [current_machine, machine]
+
+    def reindexPositions(self, solution, machine, start):
+        """Update the positions of the operations of a machine from the given index on"""
+        operations = solution[machine]
+        for i in range(min(start, len(operations)), len(operations)):
+            self.OpPositions[operations[i][0]] = (machine, i)
+
+    def undoMoves(self, solution):
+        """Revert the moves applied to the solution since the undo log was last cleared"""
+        while self.UndoLog:
+            kind, machine, op_idx, *other = self.UndoLog.pop()
+            operations = solution[machine]
+            if kind == "move":
+                other_idx = other[0]
+                operations[op_idx], operations[other_idx] = operations[other_idx], operations[op_idx]
+                self.OpPositions[operations[op_idx][0]] = (machine, op_idx)
+                self.OpPositions[operations[other_idx][0]] = (machine, other_idx)
+            else:
+                target, index = other
+                operations.insert(op_idx, solution[target].pop(index))
+                self.reindexPositions(solution, target, index)
+                self.reindexPositions(solution, machine, op_idx)
+
+    def buildSolution(self, sequences):
+        """Solution dictionary with new data lists for the given machine sequences of operation ids"""
+        return {
+            machine: [(op, [self.Operations[op].ItemRelated.Name, self.Operations[op], 0, 0]) for op in ops]
+            for machine, ops in sequences.items()
+        }
 
-        return solution_aux, current_machine
+    def snapshotSolution(self):
+        """Compact copy of the current solution: the (operation id, ST, CoT) sequence of each machine, taken from
+        the state cached by objFun for the accepted sequences"""
+        snapshot = {}
+        for machine, (_, _, prefix) in self.MachineObjFun.items():
+            snapshot[machine] = [(op, state[0], state[1]) for op, state in zip(*prefix)] if prefix else []
+        return snapshot
+
+    def rehydrateSolution(self, snapshot):
+        """Rebuild a solution dictionary from a snapshot, with new data lists for its operations"""
+        return {
+            machine: [(op, [self.Operations[op].ItemRelated.Name, self.Operations[op], ST, CoT]) for op, ST, CoT in ops]
+            for machine, ops in snapshot.items()
+        }
+
+    def optimize(self):
+        """Run the Torc optimizer selected by torc_optimizer (the exact one for runs of up to torc_exact_max_operations
+        operations), or compare the optimizers listed in torc_benchmark from the same initial solution, and finalize
+        the best solution found. Each optimizer returns the snapshot,
+        tardiness and early completion of its best solution."""
+        optimizers = {
+            "sa": self.simulatedAnnealing,
+            "parallel_tempering": self.parallelTempering,
+            "tabu": self.tabuSearch,
+            "lns": self.lnsSearch,
+            "exact": self.exactSchedule,
+        }
+        names = get_setting(self.DataHandler, "torc_benchmark") or [get_setting(self.DataHandler, "torc_optimizer")]
+        unknown = [name for name in names if name not in optimizers]
+        if unknown:
+            raise ValueError(f"Unknown Torc optimizer(s) {unknown}, expected one of {list(optimizers)}")
+        # Small runs are scheduled exactly unless optimizers are being compared
+        exact_max_operations = get_setting(self.DataHandler, "torc_exact_max_operations")
+        if len(names) == 1 and exact_max_operations and len(self.Operations) <= exact_max_operations:
+            names = ["exact"]
+
+        best_result, results = None, []
+        for name in names:
+            st = tm.time()
+            result = optimizers[name]()
+            results.append(f"{name}: atraso {result[1]:.2f} ({tm.time() - st:.2f}s)")
+            if best_result is None or result[1] < best_result[1] or (
+                    result[1] == best_result[1] and result[2] > best_result[2]):
+                best_result = result
+        if len(names) > 1:
+            print(f"Comparação de otimizadores - Torcedura: {', '.join(results)}")
+
+        return self.finalizeSolution(self.rehydrateSolution(best_result[0]))
 
     def simulatedAnnealing(self):
         '''Simulated Annealing algorithm implementation for optimizing the scheduling problem.'''
         # Parameters
-        initial_temp = 1000 * len(self.Operations)
-        final_temp = 0.01
-        max_iter_per_temp = 200
-        alpha = 0.95
-
-        # Initial solution and its objective value
-        current_solution = self.InitialSolution
+        initial_temp = get_setting(self.DataHandler, "torc_sa_initial_temp") * len(self.Operations)
+        final_temp = get_setting(self.DataHandler, "torc_sa_final_temp")
+        max_iter_per_temp = get_setting(self.DataHandler, "torc_sa_iterations_per_temp")
+        alpha = get_setting(self.DataHandler, "torc_sa_alpha")
+        adaptive_cooling = get_setting(self.DataHandler, "torc_sa_adaptive_cooling")
+        max_acceptance = get_setting(self.DataHandler, "torc_sa_max_acceptance")
+        reheat_after = get_setting(self.DataHandler, "torc_sa_reheat_after")
+        reheat_temp = get_setting(self.DataHandler, "torc_sa_reheat_ratio") * initial_temp
+        max_reheats = get_setting(self.DataHandler, "torc_sa_max_reheats")
+        max_no_improvement = get_setting(self.DataHandler, "torc_sa_max_no_improvement")
+        time_limit = get_setting(self.DataHandler, "torc_sa_time_limit")
+        target_tardiness = get_setting(self.DataHandler, "torc_sa_target_tardiness")
+        deadline = tm.time() + time_limit if time_limit and time_limit > 0 else None
+
+        # Initial solution and its objective value. Moves are applied to it in place and undone when rejected
+        current_solution = self.buildSolution(self.InitialSequences)
+        self.MachineObjFun = {}
         current_weights, _ = self.objFun(current_solution)
+        self.indexPositions(current_solution)
         
-        best_solution = copy.deepcopy(current_solution)
+        best_solution = self.snapshotSolution()
         current_tardiness = current_weights['tardiness']
         best_tardiness = current_tardiness
+        best_early_completion = current_weights['early_completion']
         
         temperature = initial_temp
         iter_total = no_improvement_iterations = 0
         attempted_moves = set()  # Track moves that don't improve the solution
         self.last_move = None
+        stagnant_temps = reheats = best_iter = 0
+        stop_reason = None
 
-        while temperature > final_temp:
+        while temperature > final_temp and stop_reason is None:
+            evaluated = accepted = 0
+            best_at_temp = best_tardiness
             for _ in range(max_iter_per_temp):
+                if target_tardiness is not None and best_tardiness <= target_tardiness:
+                    stop_reason = "objetivo atingido"
+                elif max_no_improvement and iter_total - best_iter >= max_no_improvement:
+                    stop_reason = "sem melhorias"
+                elif deadline is not None and tm.time() > deadline:
+                    stop_reason = "limite de tempo"
+                if stop_reason:
+                    break
                 iter_total += 1
                 
                 if self.user_id:
@@ -1732,24 +2832,28 @@ class TorcPandS():
 
                 candidate_weights, candidate_obj  = self.objFun(
                     candidate_solution, updated_machines)
+                evaluated += 1
 
                 # Calculate the change in objective value 
                 delta_tardiness = candidate_weights["tardiness"] - current_tardiness
 
                 # Acceptance condition: if candidate solution is better, accept it
                 if delta_tardiness < 0:
+                    accepted += 1
                     current_solution = candidate_solution
                     current_tardiness = candidate_weights["tardiness"]
                     self.MachineObjFun = candidate_obj 
+                    self.UndoLog.clear()
                     
                     # Update the best solution found so far
                     if candidate_weights["tardiness"] < best_tardiness or (
                             candidate_weights["tardiness"] == best_tardiness and candidate_weights["early_completion"] > best_early_completion
                     ):
-                        best_solution = candidate_solution
+                        best_solution = self.snapshotSolution()
                         best_tardiness = candidate_weights["tardiness"]
                         best_early_completion = candidate_weights["early_completion"]
                         no_improvement_iterations = 0  # Reset counter
+                        best_iter = iter_total
                         attempted_moves.clear()  # Reset attempted moves on improvement
                         #print(
                         #    f"Iter {iter_total}: Best tardiness improved to {best_tardiness} with early completion {best_early_completion}")
@@ -1757,22 +2861,37 @@ class TorcPandS():
                     # Accept worse solutions with a probability P
                     probability = math.exp(-delta_tardiness / temperature)
                     if random.random() < probability:
+                        accepted += 1
                         current_solution = candidate_solution
                         current_tardiness = candidate_weights["tardiness"]
                         self.MachineObjFun = candidate_obj 
+                        self.UndoLog.clear()
                         no_improvement_iterations += 1
                         #print(f"Iter {iter_total}: Worse solution accepted with objValue {current_tardiness}")
                     else:
+                        self.undoMoves(current_solution)
                         # Record unsuccessful move to avoid repeating it
                         if self.last_move:
                             attempted_moves.add(self.last_move)
                         no_improvement_iterations += 1
 
-            # Cool down the temperature
-            temperature *= alpha
+            # Reheat when the best solution has not improved for reheat_after temperatures
+            stagnant_temps = stagnant_temps + 1 if best_tardiness >= best_at_temp else 0
+            if reheat_after and stagnant_temps >= reheat_after and reheats < max_reheats:
+                temperature = max(temperature, reheat_temp)
+                stagnant_temps = 0
+                reheats += 1
+            # Cool down the temperature, faster while most moves are accepted
+            elif adaptive_cooling and evaluated and accepted / evaluated > max_acceptance:
+                temperature *= alpha ** 2
+            else:
+                temperature *= alpha
+
+        if stop_reason or reheats:
+            print(f"Recozimento simulado - Torcedura: {iter_total} iterações, {reheats} reaquecimentos, "
+                  f"paragem: {stop_reason or 'temperatura final'}, atraso {best_tardiness:.2f}")
             
-        # Finalize solution
-        return self.finalizeSolution(best_solution)
+        return best_solution, best_tardiness, best_early_completion
         
         # Calculate max CoT for each machine and sort best_solution
         machine_max_CoT = {}
@@ -1939,6 +3058,438 @@ class TorcPandS():
         
         return printed_prod_names
     
+    def runChain(self, sequences, temperature, iterations, seed):
+        """Run SA iterations at a fixed temperature from the given machine sequences (operation ids). Returns the
+        final sequences and tardiness, and the snapshot, tardiness and early completion of the best solution found"""
+        random.seed(seed)
+        solution = self.buildSolution(sequences)
+        self.MachineObjFun = {}
+        weights, _ = self.objFun(solution)
+        self.indexPositions(solution)
+        current_tardiness = best_tardiness = weights['tardiness']
+        best_early_completion = weights['early_completion']
+        best_solution = self.snapshotSolution()
+        attempted_moves = set()
+        self.last_move = None
+
+        for iter_num in range(1, iterations + 1):
+            candidate_solution, updated_machines = self.generateMove(solution, iter_num, attempted_moves)
+            if not updated_machines:
+                continue
+
+            candidate_weights, candidate_obj = self.objFun(candidate_solution, updated_machines)
+            delta_tardiness = candidate_weights["tardiness"] - current_tardiness
+            if delta_tardiness < 0 or random.random() < math.exp(-delta_tardiness / temperature):
+                current_tardiness = candidate_weights["tardiness"]
+                self.MachineObjFun = candidate_obj
+                self.UndoLog.clear()
+                if candidate_weights["tardiness"] < best_tardiness or (
+                        candidate_weights["tardiness"] == best_tardiness and candidate_weights["early_completion"] > best_early_completion
+                ):
+                    best_solution = self.snapshotSolution()
+                    best_tardiness = candidate_weights["tardiness"]
+                    best_early_completion = candidate_weights["early_completion"]
+                    attempted_moves.clear()
+            else:
+                self.undoMoves(solution)
+                if self.last_move:
+                    attempted_moves.add(self.last_move)
+
+        sequences = {machine: [op for op, _ in ops] for machine, ops in solution.items()}
+        return sequences, current_tardiness, best_solution, best_tardiness, best_early_completion
+
+    def parallelTempering(self):
+        """Run SA chains on a geometric temperature ladder in worker processes, exchanging the solutions of
+        neighbouring chains after every round with the Metropolis criterion"""
+        chains = get_setting(self.DataHandler, "torc_pt_chains")
+        if chains < 2 or len(self.Operations) < 2:
+            return self.simulatedAnnealing()
+        initial_temp = get_setting(self.DataHandler, "torc_sa_initial_temp") * len(self.Operations)
+        min_temp_ratio = get_setting(self.DataHandler, "torc_pt_min_temp_ratio")
+        rounds = get_setting(self.DataHandler, "torc_pt_rounds")
+        iterations = get_setting(self.DataHandler, "torc_pt_iterations")
+        seed = get_setting(self.DataHandler, "torc_pt_seed")
+        time_limit = get_setting(self.DataHandler, "torc_sa_time_limit")
+        deadline = tm.time() + time_limit if time_limit and time_limit > 0 else None
+
+        # Hottest chain first
+        temperatures = [initial_temp * min_temp_ratio ** (k / (chains - 1)) for k in range(chains)]
+
+        self.MachineObjFun = {}
+        weights, _ = self.objFun(self.buildSolution(self.InitialSequences))
+        best_solution = self.snapshotSolution()
+        best_tardiness, best_early_completion = weights['tardiness'], weights['early_completion']
+        sequences = [{machine: list(ops) for machine, ops in self.InitialSequences.items()} for _ in range(chains)]
+        energies = [best_tardiness] * chains
+        rng = random.Random(seed)
+        exchanges = attempts = rounds_run = 0
+
+        # The chain data is pickled once per run, abort requests are checked here between rounds
+        run_key = next(TORC_RUN_KEYS)
+        chain_data = pickle.dumps({name: getattr(self, name) for name in TORC_CHAIN_DATA})
+        pool = startTorcWorkers()
+        for round_number in range(rounds):
+            if self.user_id:
+                check_abort(self.user_id)
+            if deadline is not None and tm.time() > deadline:
+                break
+
+            tasks = [(run_key, chain_data, sequences[k], temperatures[k], iterations, hash((seed, round_number, k)))
+                     for k in range(chains)]
+            for k, (chain_sequences, energy, chain_best, chain_tardiness, chain_early) in enumerate(
+                    pool.map(runTorcChain, tasks)):
+                sequences[k], energies[k] = chain_sequences, energy
+                if chain_tardiness < best_tardiness or (
+                        chain_tardiness == best_tardiness and chain_early > best_early_completion
+                ):
+                    best_solution, best_tardiness, best_early_completion = chain_best, chain_tardiness, chain_early
+
+            # Exchange neighbouring chains, alternating between even and odd pairs
+            for k in range(round_number % 2, chains - 1, 2):
+                attempts += 1
+                exponent = (energies[k] - energies[k + 1]) * (1 / temperatures[k] - 1 / temperatures[k + 1])
+                if exponent >= 0 or rng.random() < math.exp(exponent):
+                    sequences[k], sequences[k + 1] = sequences[k + 1], sequences[k]
+                    energies[k], energies[k + 1] = energies[k + 1], energies[k]
+                    exchanges += 1
+            rounds_run += 1
+
+        print(f"Têmpera paralela - Torcedura: {chains} cadeias, {rounds_run} rondas, "
+              f"{exchanges}/{attempts} trocas, atraso {best_tardiness:.2f}")
+        return best_solution, best_tardiness, best_early_completion
+
+    def sampleMove(self, solution, rng):
+        """Random swap of two operations of different items, or insertion of an operation at a random position of
+        one of its machines. Returns the move as a tuple, or None."""
+        op = rng.choice(self.OperationIds)
+        if op not in self.OpPositions:
+            return None
+        if rng.random() < 0.5:
+            other = rng.choice(self.OperationIds)
+            if other == op or self.Operations[op].ItemRelated.Name == self.Operations[other].ItemRelated.Name:
+                return None
+            return ("swap", op, other)
+        routings = self.RoutingCache.get(self.Operations[op].ItemRelated.Name, [])
+        if not routings:
+            return None
+        machine = rng.choice(routings).MachineCode
+        length = len(solution[machine]) - (self.OpPositions[op][0] == machine)
+        return ("insert", op, machine, rng.randint(0, length))
+
+    def movedOperations(self, move):
+        return move[1:3] if move[0] == "swap" else move[1:2]
+
+    def applyMove(self, solution, move):
+        """Apply a move of sampleMove in place. Returns the changed machines."""
+        if move[0] == "swap":
+            _, machine = self.machineMove(solution, move[1], move[2])
+            return [machine] if machine else []
+        _, updated_machines = self.machineInsert(solution, *move[1:])
+        return updated_machines
+
+    def tabuSearch(self):
+        """Tabu search: every iteration evaluates a sampled neighbourhood of swaps and insertions with the delta
+        objective and applies the best move whose operations are not tabu (or that improves the best solution).
+        Moved operations stay tabu for torc_tabu_tenure iterations."""
+        iterations = get_setting(self.DataHandler, "torc_tabu_iterations")
+        neighbourhood = get_setting(self.DataHandler, "torc_tabu_neighbourhood")
+        tenure = get_setting(self.DataHandler, "torc_tabu_tenure")
+        max_no_improvement = get_setting(self.DataHandler, "torc_tabu_max_no_improvement")
+        time_limit = get_setting(self.DataHandler, "torc_tabu_time_limit")
+        deadline = tm.time() + time_limit if time_limit and time_limit > 0 else None
+        rng = random.Random(get_setting(self.DataHandler, "torc_tabu_seed"))
+
+        solution = self.buildSolution(self.InitialSequences)
+        self.MachineObjFun = {}
+        weights, _ = self.objFun(solution)
+        self.indexPositions(solution)
+        best_solution = self.snapshotSolution()
+        best_tardiness, best_early_completion = weights['tardiness'], weights['early_completion']
+        tabu_until = {}  # Operation -> last iteration in which it is tabu
+        best_iter = 0
+
+        for iter_num in range(1, iterations + 1):
+            if self.user_id:
+                check_abort(self.user_id)
+            if (max_no_improvement and iter_num - best_iter > max_no_improvement) or (deadline is not None and tm.time() > deadline):
+                break
+
+            # Evaluate the sampled moves and undo them, keeping the best admissible one
+            best_move = best_key = None
+            for _ in range(neighbourhood):
+                move = self.sampleMove(solution, rng)
+                if move is None:
+                    continue
+                updated_machines = self.applyMove(solution, move)
+                if not updated_machines:
+                    continue
+                candidate_weights, candidate_obj = self.objFun(solution, updated_machines)
+                self.undoMoves(solution)
+
+                tabu = any(tabu_until.get(op, 0) >= iter_num for op in self.movedOperations(move))
+                if tabu and candidate_weights["tardiness"] >= best_tardiness:
+                    continue
+                key = (candidate_weights["tardiness"], -candidate_weights["early_completion"])
+                if best_key is None or key < best_key:
+                    best_move, best_key, best_weights, best_obj = move, key, candidate_weights, candidate_obj
+
+            if best_move is None:
+                continue
+
+            # The same sequences give the state evaluated for the move
+            self.applyMove(solution, best_move)
+            self.MachineObjFun = best_obj
+            self.UndoLog.clear()
+            for op in self.movedOperations(best_move):
+                tabu_until[op] = iter_num + tenure
+
+            if best_weights["tardiness"] < best_tardiness or (
+                    best_weights["tardiness"] == best_tardiness and best_weights["early_completion"] > best_early_completion
+            ):
+                best_solution = self.snapshotSolution()
+                best_tardiness, best_early_completion = best_weights["tardiness"], best_weights["early_completion"]
+                best_iter = iter_num
+
+        return best_solution, best_tardiness, best_early_completion
+
+    def lnsSearch(self):
+        """Large neighbourhood search: every iteration frees the operations of a few late production orders (or a
+        window of operations on a few machines), re-sequences them with repairNeighbourhood and keeps the result if
+        the objective improves"""
+        iterations = get_setting(self.DataHandler, "torc_lns_iterations")
+        time_limit = get_setting(self.DataHandler, "torc_lns_time_limit")
+        deadline = tm.time() + time_limit if time_limit and time_limit > 0 else None
+        rng = random.Random(get_setting(self.DataHandler, "torc_lns_seed"))
+
+        solution = self.buildSolution(self.InitialSequences)
+        self.MachineObjFun = {}
+        weights, _ = self.objFun(solution)
+        current_tardiness, current_early_completion = weights['tardiness'], weights['early_completion']
+        improvements = iter_num = 0
+
+        for iter_num in range(1, iterations + 1):
+            if self.user_id:
+                check_abort(self.user_id)
+            if deadline is not None and tm.time() > deadline:
+                break
+
+            freed = self.lnsNeighbourhood(solution, rng, iter_num)
+            sequences = self.repairNeighbourhood(solution, freed) if freed else None
+            if not sequences:
+                continue
+
+            operations = {operation[0]: operation for ops in solution.values() for operation in ops}
+            candidate_solution = dict(solution)
+            for machine, ops in sequences.items():
+                candidate_solution[machine] = [operations[op] for op in ops]
+            candidate_weights, candidate_obj = self.objFun(candidate_solution, list(sequences))
+
+            if candidate_weights["tardiness"] < current_tardiness or (
+                    candidate_weights["tardiness"] == current_tardiness and candidate_weights["early_completion"] > current_early_completion
+            ):
+                solution = candidate_solution
+                self.MachineObjFun = candidate_obj
+                current_tardiness, current_early_completion = candidate_weights["tardiness"], candidate_weights["early_completion"]
+                improvements += 1
+
+        print(f"LNS - Torcedura: {iter_num} iterações, {improvements} melhorias, atraso {current_tardiness:.2f}")
+        return self.snapshotSolution(), current_tardiness, current_early_completion
+
+    def exactSchedule(self):
+        """Schedule all operations with the CP-SAT model of repairNeighbourhood, freeing every operation and without
+        the torc_lns_max_tasks cap. The solver status and gap are those of the model, which has the tardiness and
+        alternation penalty of objFun on times rounded to seconds and leaves out early completion, so the tardiness
+        objFun gives the schedule is reported next to them. Keeps the initial solution if it evaluates better."""
+        solution = self.buildSolution(self.InitialSequences)
+        self.MachineObjFun = {}
+        weights, _ = self.objFun(solution)
+        initial = self.snapshotSolution(), weights['tardiness'], weights['early_completion']
+        initial_obj = self.MachineObjFun
+
+        freed = {op for ops in solution.values() for op, _ in ops}
+        sequences = self.repairNeighbourhood(solution, freed, get_setting(self.DataHandler, "torc_exact_time_limit"),
+                                             get_setting(self.DataHandler, "torc_exact_workers"),
+                                             len(self.OperationIds)) if freed else None
+        if sequences is None:
+            print(f"CP-SAT exato sem solução - Torcedura: {self.RepairStatus[0] if freed else 'sem operações'}")
+            return initial
+
+        operations = {operation[0]: operation for ops in solution.values() for operation in ops}
+        self.MachineObjFun = {}
+        weights, _ = self.objFun({machine: [operations[op] for op in sequences.get(machine, [])] for machine in solution})
+
+        status, objective, bound = self.RepairStatus
+        gap = (objective - bound) / objective if objective else 0.0
+        print(f"CP-SAT exato - Torcedura: {status} no modelo, objetivo {objective / 60:.2f}, limite {bound / 60:.2f}, "
+              f"gap {gap:.2%} | atraso avaliado {weights['tardiness']:.2f}")
+
+        if weights['tardiness'] > initial[1] or (weights['tardiness'] == initial[1] and weights['early_completion'] < initial[2]):
+            # Back to the evaluation of the initial solution
+            self.MachineObjFun = initial_obj
+            return initial
+        return self.snapshotSolution(), weights['tardiness'], weights['early_completion']
+
+    def lnsNeighbourhood(self, solution, rng, iter_num):
+        """Operations to re-sequence: on even iterations all operations of up to torc_lns_orders late production
+        orders, otherwise (or without late orders) torc_lns_window consecutive operations on torc_lns_machines machines"""
+        if iter_num % 2 == 0:
+            late_orders = set()
+            for machine, (_, _, prefix) in self.MachineObjFun.items():
+                for op, state in zip(*prefix) if prefix else ():
+                    if state[1] > self.Operations[op].ProductionOrder.DD:
+                        late_orders.add(self.Operations[op].ProductionOrder.id)
+            if late_orders:
+                chosen = set(rng.sample(sorted(late_orders), min(len(late_orders), get_setting(self.DataHandler, "torc_lns_orders"))))
+                return {op for ops in solution.values() for op, data in ops if data[1].ProductionOrder.id in chosen}
+
+        machines = sorted(machine for machine, ops in solution.items() if ops)
+        if not machines:
+            return set()
+        window = get_setting(self.DataHandler, "torc_lns_window")
+        freed = set()
+        for machine in rng.sample(machines, min(len(machines), get_setting(self.DataHandler, "torc_lns_machines"))):
+            start = rng.randrange(len(solution[machine]))
+            freed.update(op for op, _ in solution[machine][start:start + window])
+        return freed
+
+    def repairNeighbourhood(self, solution, freed, time_limit=None, workers=None, max_tasks=None):
+        """Re-sequence the freed operations with a CP-SAT model. Each machine they can run on keeps its operations
+        that start before the earliest freed operation and its last operations beyond max_tasks (torc_lns_max_tasks
+        by default) fixed; the operations in between keep their relative order and the freed operations are placed
+        among them. Sequencing uses a circuit per machine with the material setup times, and the Tref completion of
+        each production order is its release date. The model minimizes tardiness plus the item alternation penalty
+        of objFun, including its tardiness bonus. Returns the new operation sequence of every modelled machine, or
+        None without a solution. The solver status, objective and best bound (seconds) are kept in RepairStatus."""
+        max_tasks = max_tasks or get_setting(self.DataHandler, "torc_lns_max_tasks")
+        origin = self.DataHandler.CurrentTime.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = lambda dt: int(round((dt - origin).total_seconds()))
+        # Alternation penalty of objFun (minutes): 500 plus a tenth of the tardiness of the operation after the
+        # alternation, up to 300. The objective is in tenths of a second so that the bonus stays integer.
+        alternation_penalty, bonus_cap = 500 * 60 * 10, 300 * 60 * 10
+        alternations = defaultdict(list)
+
+        states = {machine: prefix for machine, (_, _, prefix) in self.MachineObjFun.items()}
+        freed_start = min(state[0] for machine, prefix in states.items() if prefix
+                          for op, state in zip(*prefix) if op in freed)
+        machines = sorted({machine for machine, ops in solution.items() if any(op in freed for op, _ in ops)} |
+                          {machine.MachineCode for op in freed
+                           for machine in self.RoutingCache.get(self.Operations[op].ItemRelated.Name, [])})
+
+        model = cp_model.CpModel()
+        tardiness, presence, ends, circuits = {}, defaultdict(dict), {}, {}
+        penalties = []
+        horizon = seconds(max([self.TrefCoTCache.get(self.Operations[op].ProductionOrder.id, origin) for op in self.OperationIds] +
+                              [self.MachinePreviousPlanCoT[machine][1] for machine in machines] +
+                              [state[1] for prefix in states.values() if prefix for state in prefix[1]]))
+        horizon += sum(max(int(round(1.08 * 60 * self.getCycleTime(machine, self.Operations[op].ItemRelated.Name) *
+                                     self.Operations[op].Quantity))
+                           for machine in machines if self.getCycleTime(machine, self.Operations[op].ItemRelated.Name) is not None)
+                       for ops in solution.values() for op, _ in ops)
+        horizon += int(3600 * max(self.SetupTimesCache.values(), default=0)) * len(self.OperationIds)
+
+        for op in freed:
+            tardiness[op] = model.NewIntVar(0, horizon, f"T_{op}")
+
+        for machine in machines:
+            ops = [op for op, _ in solution[machine]]
+            prefix_states = states[machine][1] if states.get(machine) else []
+            k = next((i for i, op in enumerate(ops) if op in freed or prefix_states[i][0] >= freed_start), len(ops))
+            fixed = [op for op in ops[k:] if op not in freed]
+            fixed, tail = fixed[:max_tasks], fixed[max_tasks:]
+            optional = sorted(op for op in freed if self.getCycleTime(machine, self.Operations[op].ItemRelated.Name) is not None)
+            tasks = fixed + [op for op in optional if op not in fixed]
+
+            # State after the fixed prefix
+            if k:
+                ready, previous_type, previous_item = prefix_states[k - 1][1], prefix_states[k - 1][2], prefix_states[k - 1][3]
+            else:
+                previous_item = self.MachinePreviousPlanCoT[machine][0]
+                ready = self.MachinePreviousPlanCoT[machine][1]
+                previous_type = self.MaterialTypeCache.get(previous_item) if previous_item else None
+                previous_item = None
+            ready = max(seconds(ready), seconds(self.MachinePreviousPlanCoT[machine][1]))
+
+            info = []
+            for op in tasks:
+                exec_plan = self.Operations[op]
+                item = exec_plan.ItemRelated.Name
+                duration = int(round(1.08 * 60 * self.getCycleTime(machine, item) * exec_plan.Quantity))
+                release = max(seconds(self.TrefCoTCache.get(exec_plan.ProductionOrder.id, origin)),
+                              seconds(self.MachinePreviousPlanCoT[machine][1]))
+                info.append((op, item, self.getMaterialType(item), duration, release))
+                ends[op, machine] = model.NewIntVar(0, horizon, f"end_{op}_{machine}")
+                if op in freed:
+                    presence[op][machine] = model.NewBoolVar(f"on_{op}_{machine}")
+                    model.Add(tardiness[op] >= ends[op, machine] - seconds(exec_plan.ProductionOrder.DD)).OnlyEnforceIf(presence[op][machine])
+                else:
+                    tardiness[op] = model.NewIntVar(0, horizon, f"T_{op}")
+                    model.Add(tardiness[op] >= ends[op, machine] - seconds(exec_plan.ProductionOrder.DD))
+
+            def setup(from_type, to_type):
+                return int(round(3600 * self.getSetupTime(from_type, to_type))) if from_type != to_type else 0
+
+            arcs = [(0, 0, model.NewBoolVar(f"empty_{machine}"))]
+            for i, (op, item, material, duration, release) in enumerate(info, 1):
+                first = model.NewBoolVar(f"first_{op}_{machine}")
+                arcs.append((0, i, first))
+                model.Add(ends[op, machine] >= max(ready, release) + setup(previous_type, material) + duration).OnlyEnforceIf(first)
+                if previous_item and previous_item != item:
+                    penalties.append(alternation_penalty * first)
+                    alternations[op].append(first)
+                arcs.append((i, 0, model.NewBoolVar(f"last_{op}_{machine}")))
+                if op in freed:
+                    arcs.append((i, i, presence[op][machine].Not()))
+                for j, (next_op, next_item, next_material, next_duration, next_release) in enumerate(info, 1):
+                    if i == j:
+                        continue
+                    arc = model.NewBoolVar(f"arc_{op}_{next_op}_{machine}")
+                    arcs.append((i, j, arc))
+                    changeover = setup(material, next_material) + next_duration
+                    model.Add(ends[next_op, machine] >= ends[op, machine] + changeover).OnlyEnforceIf(arc)
+                    model.Add(ends[next_op, machine] >= next_release + changeover).OnlyEnforceIf(arc)
+                    if item != next_item:
+                        penalties.append(alternation_penalty * arc)
+                        alternations[next_op].append(arc)
+            model.AddCircuit(arcs)
+
+            # Fixed operations keep their relative order
+            for op, next_op in zip(fixed, fixed[1:]):
+                model.Add(ends[next_op, machine] >= ends[op, machine] + info[tasks.index(next_op)][3])
+            circuits[machine] = (ops[:k], tasks, tail, arcs)
+
+        for op in freed:
+            if not presence[op]:
+                self.RepairStatus = ("MODEL_INVALID", None, None)
+                return None
+            model.AddExactlyOne(presence[op].values())
+
+        # Tardiness bonus of the alternations, an operation has a single predecessor
+        for op, literals in alternations.items():
+            capped = model.NewIntVar(0, bonus_cap, f"capped_T_{op}")
+            model.AddMinEquality(capped, [tardiness[op], bonus_cap])
+            bonus = model.NewIntVar(0, bonus_cap, f"bonus_{op}")
+            model.Add(bonus >= capped - bonus_cap * (1 - sum(literals)))
+            penalties.append(bonus)
+        model.Minimize(10 * sum(tardiness.values()) + sum(penalties))
+
+        solver = cp_model.CpSolver()
+        solver.parameters.max_time_in_seconds = time_limit or get_setting(self.DataHandler, "torc_lns_cpsat_time_limit")
+        solver.parameters.num_workers = workers or get_setting(self.DataHandler, "torc_lns_cpsat_workers")
+        status = solver.Solve(model)
+        self.RepairStatus = (solver.StatusName(status), solver.ObjectiveValue() / 10, solver.BestObjectiveBound() / 10)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return None
+
+        sequences = {}
+        for machine, (prefix, tasks, tail, arcs) in circuits.items():
+            successor = {i: j for i, j, arc in arcs if i != j and solver.BooleanValue(arc)}
+            order, node = [], successor.get(0, 0)
+            while node:
+                order.append(tasks[node - 1])
+                node = successor[node]
+            sequences[machine] = prefix + order + tail
+        return sequences
+
     def generateMove(self, solution, iter_num, attempted_moves):
         """Generate a candidate move"""
         updated_machines = []
@@ -1949,7 +3500,7 @@ class TorcPandS():
             if len(self.Operations) < 2:
                 return solution, []
                 
-            op1, op2 = random.sample(list(self.Operations.keys()), 2)
+            op1, op2 = random.sample(self.OperationIds, 2)
             
             # Skip if already attempted or same item
             if ((op1, op2) in attempted_moves or 
@@ -1967,7 +3518,7 @@ class TorcPandS():
                 attempted_moves.add((op1, op2))
         else:
             # Machine switch: move operation to different machine
-            op = random.choice(list(self.Operations.keys()))
+            op = random.choice(self.OperationIds)
             routings = self.RoutingCache.get(self.Operations[op].ItemRelated.Name, [])
             
             if not routings:
@@ -0,0 +1,204 @@
+# Default algorithm settings. Each key can be overridden per branch (BRANCH_SETTINGS)
+# and per run (DataHandler.Settings, filled from the /runAlgorithm request body).
+DEFAULT_SETTINGS = {
+    # Maximum number of BoM combinations evaluated by ROD planning
+    "rod_max_combinations": 10000,
+    # Maximum number of BoM combinations evaluated per batch of production orders in Tref planning
+    "tref_max_combinations": 5000,
+    # Seed used to sample combinations when the full space exceeds the cap
+    "combination_sampling_seed": 0,
+    # Drop Tref BoM alternatives that cannot reach the best packing value of their batch before enumerating combinations
+    "tref_dominance_pruning": True,
+    # Tref packing engine: "heuristic" (knapsack rounds), "cpsat" (global CP-SAT model), "patterns" (time unit
+    # loading patterns) or "compare" (heuristic and CP-SAT, keep the better)
+    "tref_engine": "heuristic",
+    # Maximum number of time unit loading patterns per machine and item class of the "patterns" engine
+    "tref_max_patterns": 5000,
+    # Time limit (seconds) and worker threads of each CP-SAT Tref solve
+    "tref_cpsat_time_limit": 10.0,
+    "tref_cpsat_workers": 8,
+    # Solve easy Tref knapsack rounds greedily when the greedy packing is provably optimal
+    "kp_fast_path": True,
+    # Backend of the Tref knapsack MILP ("SCIP", "CBC", "CP_SAT" or "HIGHS" if OR-Tools was built with it)
+    "kp_solver": "SCIP",
+    # Time limit (seconds), relative gap and threads of each knapsack solve, 0 keeps the solver default
+    "kp_time_limit": 0.0,
+    "kp_relative_gap": 0.0,
+    "kp_threads": 0,
+    # Maximum number of Tref knapsack packings kept for reuse across combinations (LRU)
+    "kp_cache_size": 20000,
+    # Time budget (seconds) of the ROD local search after planning, 0 disables it
+    "rod_local_search_time": 0.0,
+    "rod_local_search_seed": 0,
+    # Torc simulated annealing: initial temperature per operation, cooling factor, iterations per temperature and
+    # final temperature
+    "torc_sa_initial_temp": 1000.0,
+    "torc_sa_alpha": 0.95,
+    "torc_sa_iterations_per_temp": 200,
+    "torc_sa_final_temp": 0.01,
+    # Cool with alpha squared while the acceptance rate of a temperature is above torc_sa_max_acceptance
+    "torc_sa_adaptive_cooling": False,
+    "torc_sa_max_acceptance": 0.5,
+    # Temperatures without a new best solution before reheating to a fraction of the initial temperature (0 disables),
+    # and maximum number of reheats
+    "torc_sa_reheat_after": 0,
+    "torc_sa_reheat_ratio": 0.5,
+    "torc_sa_max_reheats": 3,
+    # Torc optimizer: "sa" (simulated annealing), "parallel_tempering", "tabu", "lns" (large neighbourhood search)
+    # or "exact" (CP-SAT)
+    "torc_optimizer": "sa",
+    # Optimizers run from the same initial solution and compared (the best result is kept), empty runs torc_optimizer
+    "torc_benchmark": [],
+    # Stop after this many iterations without a new best solution, after this many seconds, or once the best
+    # tardiness reaches the target (0 / None disable each rule)
+    "torc_sa_max_no_improvement": 0,
+    "torc_sa_time_limit": 0.0,
+    "torc_sa_target_tardiness": None,
+    # Torc parallel tempering: number of chains run in separate processes, exchange rounds, SA iterations per chain
+    # between exchanges and coldest temperature relative to the initial one
+    "torc_pt_chains": 4,
+    "torc_pt_rounds": 50,
+    "torc_pt_iterations": 500,
+    "torc_pt_min_temp_ratio": 0.001,
+    # Seed of the chains, which run in the server's pool of worker processes (one per CPU)
+    "torc_pt_seed": 0,
+    # Torc tabu search: iterations, sampled moves per iteration, iterations a moved operation stays tabu, iterations
+    # without a new best solution before stopping (0 disables), time limit (seconds, 0 disables) and seed
+    "torc_tabu_iterations": 2000,
+    "torc_tabu_neighbourhood": 30,
+    "torc_tabu_tenure": 10,
+    "torc_tabu_max_no_improvement": 300,
+    "torc_tabu_time_limit": 0.0,
+    "torc_tabu_seed": 0,
+    # Torc large neighbourhood search: iterations, time limit (seconds, 0 disables), late production orders freed per
+    # neighbourhood, or machines and consecutive operations per machine freed by a window neighbourhood
+    "torc_lns_iterations": 100,
+    "torc_lns_time_limit": 0.0,
+    "torc_lns_orders": 3,
+    "torc_lns_machines": 2,
+    "torc_lns_window": 6,
+    # Maximum fixed operations per machine in a CP-SAT repair model, time limit (seconds) and workers of each repair
+    "torc_lns_max_tasks": 30,
+    "torc_lns_cpsat_time_limit": 2.0,
+    "torc_lns_cpsat_workers": 8,
+    "torc_lns_seed": 0,
+    # Torc runs with at most this many operations are scheduled exactly with CP-SAT ("exact" optimizer, 0 disables),
+    # with this time limit (seconds) and workers
+    "torc_exact_max_operations": 12,
+    "torc_exact_time_limit": 30.0,
+    "torc_exact_workers": 8,
+}
+
+BRANCH_SETTINGS = {
+    "COFACTORY_GR": {},
+    "COFACTORY_PT": {},
+}
+
+def get_setting(data_handler, key):
+    """Get a setting for a run, falling back to the branch and global defaults"""
+    run_settings = getattr(data_handler, "Settings", None) or {}
+    if key in run_settings:
+        return run_settings[key]
+    branch_settings = BRANCH_SETTINGS.get(data_handler.Database, {})
+    if key in branch_settings:
+        return branch_settings[key]
+    return DEFAULT_SETTINGS[key]
+
+# Names accepted by the settings that select an engine or optimizer
+SETTING_CHOICES = {
+    "tref_engine": ("heuristic", "cpsat", "patterns", "compare"),
+    "kp_solver": ("SCIP", "CBC", "CP_SAT", "HIGHS"),
+    "torc_optimizer": ("sa", "parallel_tempering", "tabu", "lns", "exact"),
+    "torc_benchmark": ("sa", "parallel_tempering", "tabu", "lns", "exact"),
+}
+
+# Allowed (minimum, maximum) of numeric settings, None leaves a side open. Caps need at least 1, times and
+# counters cannot be negative. Settings in EXCLUSIVE_BOUNDS cannot take their bounds.
+SETTING_BOUNDS = {
+    "rod_max_combinations": (1, None),
+    "tref_max_combinations": (1, None),
+    "tref_max_patterns": (1, None),
+    "tref_cpsat_time_limit": (0, None),
+    "tref_cpsat_workers": (1, None),
+    "kp_time_limit": (0, None),
+    "kp_relative_gap": (0, 1),
+    "kp_threads": (0, None),
+    "kp_cache_size": (0, None),
+    "rod_local_search_time": (0, None),
+    "torc_sa_initial_temp": (0, None),
+    "torc_sa_alpha": (0, 1),
+    "torc_sa_iterations_per_temp": (1, None),
+    "torc_sa_final_temp": (0, None),
+    "torc_sa_max_acceptance": (0, 1),
+    "torc_sa_reheat_after": (0, None),
+    "torc_sa_reheat_ratio": (0, None),
+    "torc_sa_max_reheats": (0, None),
+    "torc_sa_max_no_improvement": (0, None),
+    "torc_sa_time_limit": (0, None),
+    "torc_sa_target_tardiness": (0, None),
+    "torc_pt_chains": (1, None),
+    "torc_pt_rounds": (1, None),
+    "torc_pt_iterations": (1, None),
+    "torc_pt_min_temp_ratio": (0, 1),
+    "torc_tabu_iterations": (1, None),
+    "torc_tabu_neighbourhood": (1, None),
+    "torc_tabu_tenure": (0, None),
+    "torc_tabu_max_no_improvement": (0, None),
+    "torc_tabu_time_limit": (0, None),
+    "torc_lns_iterations": (1, None),
+    "torc_lns_time_limit": (0, None),
+    "torc_lns_orders": (1, None),
+    "torc_lns_machines": (1, None),
+    "torc_lns_window": (1, None),
+    "torc_lns_max_tasks": (1, None),
+    "torc_lns_cpsat_time_limit": (0, None),
+    "torc_lns_cpsat_workers": (1, None),
+    "torc_exact_max_operations": (0, None),
+    "torc_exact_time_limit": (0, None),
+    "torc_exact_workers": (1, None),
+}
+EXCLUSIVE_BOUNDS = {"torc_sa_initial_temp", "torc_sa_alpha", "torc_sa_final_temp", "torc_pt_min_temp_ratio"}
+
+def is_valid_setting(key, value):
+    """Check a value against the type of the default of the setting and its allowed names or range"""
+    default = DEFAULT_SETTINGS[key]
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(default, bool) and isinstance(value, bool)
+    if isinstance(default, list):
+        return isinstance(value, list) and all(
+            isinstance(name, str) and name in SETTING_CHOICES.get(key, ()) for name in value)
+    if isinstance(default, str):
+        return isinstance(value, str) and (key not in SETTING_CHOICES or value in SETTING_CHOICES[key])
+    if default is None and value is None:
+        return True
+    # Integer settings need integers, float (and optional numeric) settings also take integers
+    if isinstance(default, int) and not isinstance(value, int):
+        return False
+    if not isinstance(value, (int, float)):
+        return False
+
+    minimum, maximum = SETTING_BOUNDS.get(key, (None, None))
+    if key in EXCLUSIVE_BOUNDS:
+        return (minimum is None or value > minimum) and (maximum is None or value < maximum)
+    return (minimum is None or value >= minimum) and (maximum is None or value <= maximum)
+
+def update_settings(data_handler, overrides):
+    """Store the run overrides in the user's DataHandler if all of them are known and valid.
+    Returns the invalid and the unknown keys, nothing is stored if either is not empty."""
+    if overrides is None:
+        overrides = {}
+    if not isinstance(overrides, dict):
+        return ["settings"], []
+
+    invalid, ignored = [], []
+    for key, value in overrides.items():
+        if key not in DEFAULT_SETTINGS:
+            ignored.append(key)
+        elif not is_valid_setting(key, value):
+            invalid.append(key)
+    if invalid or ignored:
+        return invalid, ignored
+
+    data_handler.Settings.clear()
+    data_handler.Settings.update(overrides)
+    return invalid, ignored
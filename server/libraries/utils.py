@@ -1,4 +1,4 @@
-import numpy as np
+from collections import Counter
 from io import BytesIO
 from datetime import datetime, timedelta, time
 import time as tm
@@ -16,6 +16,7 @@ class TimeUnit:
         self.ExecutionPlans = [] #Not inserted into the DB
         self.ST = 0
         self.CoT = 0
+        self.reset_aggregates()
 
     @classmethod
     def clear_instances(cls):
@@ -29,91 +30,108 @@ class TimeUnit:
         cls.new_instances.clear()
         cls.id = 0"""
         
-    def sort_by_need(self, torc_solution):
+    def reset_aggregates(self):
+        """Running sums behind the average due date, diameter and weight and the material type histogram"""
+        self._aggregated_count = 0
+        self._due_date_sum = 0
+        self._diameter_sum, self._diameter_count = 0, 0
+        self._weight_sum = 0
+        self._material_types = Counter()
+
+    def add_execution_plan(self, exec_plan):
+        """Append an execution plan and update the aggregates"""
+        self.ExecutionPlans.append(exec_plan)
+        self._update_aggregates()
+
+    def _update_aggregates(self):
+        """Fold the execution plans appended since the last update into the aggregates, or rebuild them if the
+        list was replaced or shortened"""
+        if len(self.ExecutionPlans) < self._aggregated_count:
+            self.reset_aggregates()
+        for exec_plan in self.ExecutionPlans[self._aggregated_count:]:
+            self._due_date_sum += tm.mktime(exec_plan.ProductionOrder.DD.timetuple())
+            if exec_plan.ItemRelated:
+                self._diameter_sum += int(exec_plan.ItemRelated.Diameter * 1000)
+                self._diameter_count += 1
+            self._weight_sum += exec_plan.ProductionOrder.Weight
+            self._material_types[exec_plan.ItemRelated.MaterialType] += 1
+        self._aggregated_count = len(self.ExecutionPlans)
+
+    @staticmethod
+    def build_need_index(torc_solution):
+        """Earliest start of the TORC operations per (item, production order id) they produce"""
+        need_index = {}
+        for _, operations in (torc_solution or {}).items():
+            for _, (_, exec_plan, start_time, _) in operations:
+                key = (exec_plan.ItemRelated.Name, exec_plan.ProductionOrder.id)
+                if key not in need_index or start_time < need_index[key]:
+                    need_index[key] = start_time
+        return need_index
+
+    def sort_by_need(self, torc_solution, need_index=None):
         """
         Calculate priority based on when TORC items need this TREF item.
         Returns timestamp of earliest TORC operation that needs any item from this TimeUnit.
-        Lower values = higher priority (needed sooner)
+        Lower values = higher priority (needed sooner), TimeUnits not needed by TORC go last.
+        need_index (see build_need_index) is built from torc_solution if not given.
         """
         if not torc_solution:
             return 0
 
-        urgency_score = 0
-        earliest_need = datetime.min
-        
-        for _, operations in torc_solution.items():
-            for op in operations:
-                _, details = op
-                _, exec_plan, start_time, _ = details
-
-                # Check if this time unit produces items needed by this TORC operation
-                for tu_exec_plan in self.ExecutionPlans:
-                    if (tu_exec_plan.ItemRoot and 
-                        tu_exec_plan.ItemRoot.Name == exec_plan.ItemRelated.Name and
-                        tu_exec_plan.ProductionOrder.id == exec_plan.ProductionOrder.id):
+        if need_index is None:
+            need_index = self.build_need_index(torc_solution)
 
-                        earliest_need = min(earliest_need, start_time)
-
-        if earliest_need:
-            # Convert to urgency score (earlier = higher score)
-            urgency_score = (earliest_need - datetime.min).total_seconds()
+        # Check if this time unit produces items needed by the TORC operations
+        needs = [need_index[key] for key in ((tu_exec_plan.ItemRoot.Name, tu_exec_plan.ProductionOrder.id)
+                                             for tu_exec_plan in self.ExecutionPlans if tu_exec_plan.ItemRoot)
+                 if key in need_index]
+        if not needs:
+            return float('inf')
 
-        return urgency_score
+        # Convert to urgency score (earlier = lower score)
+        return (min(needs) - datetime.min).total_seconds()
 
     def calculate_average_due_date(self):
         """Organize the Products by Due Date"""
-        due_dates = [exec_plan.ProductionOrder.DD for exec_plan in self.ExecutionPlans]
-        if due_dates:
-            seconds = [tm.mktime(d.timetuple()) for d in due_dates]
-            avg_due_date = datetime.fromtimestamp(np.mean(seconds))
-            return avg_due_date
+        self._update_aggregates()
+        if self.ExecutionPlans:
+            return datetime.fromtimestamp(self._due_date_sum / len(self.ExecutionPlans))
         else:
             return None
 
-    def get_average_diameter(self, database):
+    def get_average_diameter(self, database=None):
         """Get the average diameter of the machine"""
-        diameters = [int(Items.get_Item(ep.ItemRelated.Name, database).Diameter * 1000) for ep in self.ExecutionPlans if
-                     Items.get_Item(ep.ItemRelated.Name, database)]
-        if diameters:
-            return np.mean(diameters)
+        self._update_aggregates()
+        if self._diameter_count:
+            return self._diameter_sum / self._diameter_count
         else:
             return float('inf')
 
     def get_primary_material_type(self):
         """Determine the primary material type among ExecutionPlans."""
-        material_types = {ep.ItemRelated.MaterialType for ep in self.ExecutionPlans}
-        if material_types:
-            return sorted(material_types)[0]  # Assuming a sorted order can determine primary type
+        self._update_aggregates()
+        if self._material_types:
+            return min(self._material_types)  # Assuming a sorted order can determine primary type
         return None
 
     def get_average_weight(self):
         """Get the average weight for execution plans with the same due date."""
-        weights = [exec_plan.ProductionOrder.Weight for exec_plan in self.ExecutionPlans]
-        if weights:
-            return np.mean(weights)
+        self._update_aggregates()
+        if self.ExecutionPlans:
+            return self._weight_sum / len(self.ExecutionPlans)
         return float('inf')
 
     def calculate_time(self, TU_ST, previous_TU, data_handler, current_time):
         shift_start_times = [time(0, 0), time(8, 0), time(16, 0)]  # Midnight, 8 AM, 4 PM
 
+        if data_handler.MachineStates is None:
+            data_handler.prefetchSchedulingState()
+        tables = data_handler.SchedulingTables
+
         def start_time():
-            with pyodbc.connect(data_handler.ConnectionString) as conn:
-                with conn.cursor() as cursor:  # Opens the cursor
-                    # Check if TimeUnits table has records for this machine
-                    cursor.execute("SELECT TOP 1 id, CompletionTime FROM TimeUnits WHERE Machine = ? ORDER BY CompletionTime DESC", (self.Machine,))
-                    result = cursor.fetchone()
-                    TU_id, latest_ep_CoT = result if result else (None, None)
-    
-                    if TU_id:
-                        cursor.execute("SELECT ExecutionPlanId FROM TimeUnitExecutionPlans WHERE TimeUnitId = ?", (TU_id,))
-                        exec_plan_id = cursor.fetchone()[0]
-    
-                        cursor.execute("SELECT Item FROM ExecutionPlans WHERE id = ?", (exec_plan_id,))
-                        previous_plan_item = cursor.fetchone()[0]
-    
-                        previous_type = next((item.MaterialType for item in data_handler.Items if item.Name == previous_plan_item), None)
-                    else:
-                        previous_type = None
+            # Last scheduled time unit of the machine, prefetched for all machines
+            latest_ep_CoT, previous_plan_item = data_handler.MachineStates.get(self.Machine, (None, None))
+            previous_type = tables["material"].get(previous_plan_item) if previous_plan_item is not None else None
 
             # Determine the initial start time
             start_time = max(latest_ep_CoT, current_time) if latest_ep_CoT else current_time
@@ -121,9 +139,7 @@ class TimeUnit:
             # Check if a setup time is needed
             current_type = self.ExecutionPlans[0].ItemRelated.MaterialType
             if current_type != previous_type:
-                setup_time = next(
-                    (float(instance.SetupTime) for instance in data_handler.SetupTimesByMaterial
-                     if instance.FromMaterial == previous_type and instance.ToMaterial == current_type), 0.0)
+                setup_time = tables["setup"].get((previous_type, current_type), 0.0)
                 start_time += timedelta(hours=setup_time)
 
             return next_shift_start_time(start_time)
@@ -144,9 +160,7 @@ class TimeUnit:
             previous_type = previous_TU.ExecutionPlans[0].ItemRelated.MaterialType
             current_type = self.ExecutionPlans[0].ItemRelated.MaterialType
             if previous_type != current_type:
-                setup_time = next(
-                    (float(instance.SetupTime) for instance in data_handler.SetupTimesByMaterial
-                     if instance.FromMaterial == previous_type and instance.ToMaterial == current_type), 0.0)
+                setup_time = tables["setup"].get((previous_type, current_type), 0.0)
             self.ST = previous_TU.CoT + timedelta(hours=setup_time) if setup_time else previous_TU.CoT
         else:
             if TU_ST is None:
@@ -160,9 +174,8 @@ class TimeUnit:
 
         # Get max completion time (CoT)      
         max_CT = max(
-            (next((routing.CycleTime / 1000) for routing in data_handler.Routings
-                  if routing.Item == exec_plan.ItemRelated.Name and routing.Machine == self.Machine)
-             * exec_plan.Quantity) for exec_plan in self.ExecutionPlans
+            tables["cycle"][(exec_plan.ItemRelated.Name, self.Machine)] * exec_plan.Quantity
+            for exec_plan in self.ExecutionPlans
         )
         self.ST += timedelta(minutes=(max_CT * 0.16))
         self.CoT = self.ST + timedelta(minutes=max_CT)
@@ -351,7 +364,38 @@ class DataHandler:
         self.RODItems, self.TorcItems, self.TrefItems = [], [], []
         self.RODSolution, self.TorcSolution = None, None
         self.Criteria = {}
+        self.Settings = {} # Per run overrides of the algorithm settings (see settings.py)
+        # Last scheduled time unit of each machine and indexed tables used by TimeUnit.calculate_time
+        self.MachineStates, self.SchedulingTables = None, None
     
+    def prefetchSchedulingState(self):
+        """Fetch the completion time and item of the last scheduled time unit of every machine in a single query,
+        and index the material types, setup times and cycle times (first match wins, as in the linear lookups)"""
+        with pyodbc.connect(self.ConnectionString) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                        SELECT Machine, CompletionTime, Item
+                        FROM (
+                            SELECT tu.Machine, tu.CompletionTime, ep.Item,
+                                   ROW_NUMBER() OVER (PARTITION BY tu.Machine ORDER BY tu.CompletionTime DESC) AS rn
+                            FROM TimeUnits tu
+                            OUTER APPLY (SELECT TOP 1 ExecutionPlanId FROM TimeUnitExecutionPlans
+                                         WHERE TimeUnitId = tu.id) tuep
+                            LEFT JOIN ExecutionPlans ep ON ep.id = tuep.ExecutionPlanId
+                        ) latest
+                        WHERE rn = 1
+                    """)
+                self.MachineStates = {machine: (CoT, item) for machine, CoT, item in cursor.fetchall()}
+
+        tables = {"material": {}, "setup": {}, "cycle": {}}
+        for item in self.Items:
+            tables["material"].setdefault(item.Name, item.MaterialType)
+        for instance in self.SetupTimesByMaterial:
+            tables["setup"].setdefault((instance.FromMaterial, instance.ToMaterial), float(instance.SetupTime))
+        for routing in self.Routings:
+            tables["cycle"].setdefault((routing.Item, routing.Machine), routing.CycleTime / 1000)
+        self.SchedulingTables = tables
+
     def removeEPbyID(self, target_id):
         self.ExecutionPlans = [instance for instance in self.ExecutionPlans if instance.id != target_id]
         
@@ -0,0 +1,49 @@
+import importlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from libraries.utils import DataHandler
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    """app.py imported as a spawned Torc worker imports it, failing on any DB load"""
+    def read_db_data(*args, **kwargs):
+        raise AssertionError("app.py loaded the DB data on import")
+
+    monkeypatch.setattr(DataHandler, "readDBData", read_db_data)
+    sys.modules.pop("app", None)
+    return importlib.import_module("app")
+
+
+def test_import_does_not_load_the_db_or_start_the_executor(app_module):
+    assert app_module.executor is None
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    """Test client with a loaded user, whose algorithm runs are not started"""
+    handler = SimpleNamespace(Database="COFACTORY_PT", Settings={"kp_threads": 2})
+    monkeypatch.setattr(app_module, "executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(app_module, "user_data", {"user": {"input_data": handler}})
+    monkeypatch.setattr(app_module, "running_algorithms", {})
+    return app_module.app.test_client(), handler
+
+
+@pytest.mark.parametrize("settings, invalid, ignored", [
+    ({"rod_max_combinations": 0}, ["rod_max_combinations"], []),
+    ({"tref_engine": "greedy", "torc_sa_alpha": 1.0}, ["torc_sa_alpha", "tref_engine"], []),
+    ({"rod_max_combination": 10}, [], ["rod_max_combination"]),
+    ({"kp_solver": "GUROBI", "unknown": True}, ["kp_solver"], ["unknown"]),
+    ("fast", ["settings"], []),
+])
+def test_run_algorithm_rejects_invalid_settings(client, settings, invalid, ignored):
+    test_client, handler = client
+    response = test_client.post("/runAlgorithm?user_id=user", json={"settings": settings})
+    assert response.status_code == 400
+    assert sorted(response.get_json()["invalid_settings"]) == invalid
+    assert response.get_json()["ignored_settings"] == ignored
+    assert handler.Settings == {"kp_threads": 2}
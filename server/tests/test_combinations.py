@@ -0,0 +1,52 @@
+from itertools import product
+
+import pytest
+
+from libraries.algorithms import boundedCombinations, countCombinations, grayCodeCombinations
+
+GROUPS = [["a", "b", "c"], ["x"], [1, 2], ["p", "q", "r", "s"]]
+
+
+def test_count_combinations():
+    assert countCombinations(GROUPS) == 24
+    assert countCombinations([]) == 1
+    assert countCombinations([["a"], []]) == 0
+
+
+def test_bounded_combinations_rejects_a_cap_below_one():
+    with pytest.raises(ValueError):
+        list(boundedCombinations(GROUPS, 0))
+
+
+@pytest.mark.parametrize("max_combinations", [24, 100])
+def test_bounded_combinations_enumerates_the_full_space_within_the_cap(max_combinations):
+    assert list(boundedCombinations(GROUPS, max_combinations)) == list(product(*GROUPS))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 7])
+def test_bounded_combinations_samples_distinct_combinations(seed):
+    sample = list(boundedCombinations(GROUPS, 10, seed))
+    assert len(sample) == len(set(sample)) == 10
+    assert set(sample) <= set(product(*GROUPS))
+    # The combination of the first alternative of every group is always visited
+    assert sample[0] == ("a", "x", 1, "p")
+    assert sample == list(boundedCombinations(GROUPS, 10, seed))
+
+
+@pytest.mark.parametrize("groups", [
+    GROUPS,
+    [["a", "b"], ["c", "d"], ["e", "f"]],
+    [[1, 2, 3, 4, 5]],
+    [["only"], ["one"]],
+    [],
+])
+def test_gray_code_combinations_cover_the_space_one_change_at_a_time(groups):
+    combinations = list(grayCodeCombinations(groups))
+    assert len(combinations) == len(set(combinations)) == countCombinations(groups)
+    assert set(combinations) == set(product(*groups))
+    for previous, current in zip(combinations, combinations[1:]):
+        assert sum(a != b for a, b in zip(previous, current)) == 1
+
+
+def test_gray_code_combinations_of_an_empty_group():
+    assert list(grayCodeCombinations([["a", "b"], []])) == []
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+from libraries.settings import DEFAULT_SETTINGS, get_setting, is_valid_setting, update_settings
+
+
+def data_handler(settings=None):
+    return SimpleNamespace(Database="COFACTORY_PT", Settings=dict(settings or {}))
+
+
+@pytest.mark.parametrize("key, value", [
+    ("rod_max_combinations", 1),
+    ("tref_engine", "compare"),
+    ("kp_solver", "CP_SAT"),
+    ("kp_relative_gap", 0),
+    ("torc_sa_alpha", 0.9),
+    ("torc_sa_initial_temp", 5),
+    ("torc_sa_target_tardiness", None),
+    ("torc_sa_target_tardiness", 60),
+    ("torc_tabu_max_no_improvement", 0),
+    ("torc_benchmark", ["sa", "tabu"]),
+    ("tref_dominance_pruning", False),
+])
+def test_valid_settings(key, value):
+    assert is_valid_setting(key, value)
+
+
+@pytest.mark.parametrize("key, value", [
+    # Caps need at least 1, times and counters cannot be negative
+    ("rod_max_combinations", 0),
+    ("tref_max_combinations", -5),
+    ("tref_cpsat_time_limit", -1.0),
+    ("kp_relative_gap", 1.5),
+    # Bounds of EXCLUSIVE_BOUNDS settings are out
+    ("torc_sa_alpha", 1),
+    ("torc_sa_initial_temp", 0),
+    ("torc_pt_min_temp_ratio", 0.0),
+    # Types of the defaults
+    ("rod_max_combinations", 10.5),
+    ("rod_max_combinations", "10"),
+    ("rod_max_combinations", True),
+    ("tref_dominance_pruning", 1),
+    ("torc_sa_alpha", None),
+    ("torc_benchmark", "sa"),
+    # Unknown names
+    ("tref_engine", "greedy"),
+    ("kp_solver", "GUROBI"),
+    ("torc_optimizer", "genetic"),
+    ("torc_benchmark", ["sa", "genetic"]),
+])
+def test_invalid_settings(key, value):
+    assert not is_valid_setting(key, value)
+
+
+def test_update_settings_stores_valid_overrides():
+    handler = data_handler({"kp_threads": 2})
+    assert update_settings(handler, {"rod_max_combinations": 500, "tref_engine": "cpsat"}) == ([], [])
+    assert handler.Settings == {"rod_max_combinations": 500, "tref_engine": "cpsat"}
+    assert get_setting(handler, "rod_max_combinations") == 500
+    assert get_setting(handler, "kp_threads") == DEFAULT_SETTINGS["kp_threads"]
+
+
+@pytest.mark.parametrize("overrides, expected", [
+    ({"rod_max_combinations": 0, "unknown": 1}, (["rod_max_combinations"], ["unknown"])),
+    ({"tref_engine": "greedy"}, (["tref_engine"], [])),
+    ({"rod_max_combination": 10}, ([], ["rod_max_combination"])),
+    (["rod_max_combinations"], (["settings"], [])),
+])
+def test_update_settings_rejects_and_stores_nothing(overrides, expected):
+    handler = data_handler({"kp_threads": 2})
+    assert update_settings(handler, overrides) == expected
+    assert handler.Settings == {"kp_threads": 2}
+
+
+def test_update_settings_without_overrides_clears_the_previous_run():
+    handler = data_handler({"kp_threads": 2})
+    assert update_settings(handler, None) == ([], [])
+    assert handler.Settings == {}
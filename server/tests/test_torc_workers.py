@@ -0,0 +1,48 @@
+import pickle
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from libraries import algorithms
+
+
+def chain_data():
+    """Chain data of two machines and three operations, as parallelTempering sends it to the workers"""
+    start = datetime(2024, 1, 1, 8)
+    items = {name: SimpleNamespace(Name=name) for name in ("A1", "B1")}
+    operations = {
+        op: SimpleNamespace(ItemRelated=items[name], Quantity=10,
+                            ProductionOrder=SimpleNamespace(id=op, DD=start + timedelta(hours=op)))
+        for op, name in ((1, "A1"), (2, "B1"), (3, "A1"))
+    }
+    machines = [SimpleNamespace(MachineCode=code) for code in ("M1", "M2")]
+    return {
+        "Operations": operations,
+        "OperationIds": list(operations),
+        "RoutingCache": {name: machines for name in items},
+        "MachinePreviousPlanCoT": {machine.MachineCode: [None, start] for machine in machines},
+        "SetupTimesCache": {("A", "B"): 0.5, ("B", "A"): 0.5},
+        "CycleTimesCache": {(machine.MachineCode, name): 6.0 for machine in machines for name in items},
+        "MaterialTypeCache": {"A1": "A", "B1": "B"},
+        "TrefCoTCache": {},
+        "DayStart": start.replace(hour=0),
+    }
+
+
+def test_chain_data_matches_the_worker_engine():
+    assert set(chain_data()) == set(algorithms.TORC_CHAIN_DATA)
+
+
+def test_spawned_worker_runs_a_chain_without_the_data_handler():
+    # The worker engine only has the chain data, any DataHandler or DB access would fail
+    task = (-1, pickle.dumps(chain_data()), {"M1": [1, 2, 3], "M2": []}, 100.0, 50, 7)
+    result = algorithms.startTorcWorkers().submit(algorithms.runTorcChain, task).result(timeout=120)
+
+    sequences, tardiness, best_solution, best_tardiness, _ = result
+    assert sorted(op for ops in sequences.values() for op in ops) == [1, 2, 3]
+    assert best_tardiness <= tardiness
+    assert sorted(op for ops in best_solution.values() for op, _, _ in ops) == [1, 2, 3]
+    assert result == algorithms.runTorcChain(task)
+
+
+def test_worker_pool_is_started_once():
+    assert algorithms.startTorcWorkers() is algorithms.startTorcWorkers()